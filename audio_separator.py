@@ -2,16 +2,23 @@ from fastapi import FastAPI, UploadFile, HTTPException, Response
 from fastapi.responses import StreamingResponse
 import torch
 import torchaudio
-from speechbrain.pretrained import SepformerSeparation as separator
 import os
 
 from app import app
+from model_registry import registry
 
-# Load the pretrained model
-model = separator.from_hparams(
-    source="speechbrain/sepformer-wham",
-    savedir="pretrained_models/sepformer-wham"
-)
+
+def load_sepformer():
+    from speechbrain.pretrained import SepformerSeparation as separator
+    # Load the pretrained model
+    return separator.from_hparams(
+        source="speechbrain/sepformer-wham",
+        savedir="pretrained_models/sepformer-wham"
+    )
+
+
+# Loaded on first use or during warmup
+registry.register("sepformer", load_sepformer)
 
 
 # Method to perform audio separation
@@ -21,7 +28,7 @@ def separate_audio(file_path: str):
         mixture_waveform, sample_rate = torchaudio.load(file_path, format='wav')
 
         # Perform separation
-        estimated_sources = model.separate_batch(mixture_waveform)
+        estimated_sources = registry.get("sepformer").separate_batch(mixture_waveform)
         return estimated_sources, sample_rate
     except Exception as e:
         raise RuntimeError(f"Audio separation failed: {str(e)}")
@@ -1,29 +1,49 @@
 # Import necessary modules
 import os
 import tempfile
+import threading
 import traceback
+from typing import Union
 
 from fastapi import FastAPI, UploadFile, HTTPException
 import uvicorn
 import numpy as np
 import librosa
-from BeatNet.BeatNet import BeatNet
 
 # Initialize FastAPI app
 from app import app
+from inference_executor import run_inference
+from decoded_audio import DecodedAudio
+from uploads import spool_upload
+from metrics import audio_duration, measure
+from model_registry import registry
 
-# Initialize the BeatNet model
-estimator = BeatNet(1, mode='offline', inference_model='DBN', plot=[], thread=False)
 
-async def analyze_beat(file_path: str):
-    """Process the audio file at the given path and return beat JSON data."""
-    # Load the audio file using librosa
+def load_estimator():
+    from BeatNet.BeatNet import BeatNet
+    return BeatNet(1, mode='offline', inference_model='DBN', plot=[], thread=False)
+
+
+# The BeatNet model, loaded on first use or during warmup
+registry.register("beatnet", load_estimator)
+estimator_lock = threading.Lock()
+BEATNET_SAMPLE_RATE = 22050
+
+def analyze_beat_sync(file_path: Union[str, DecodedAudio]):
+    """Process the audio file at the given path (or already decoded audio) and return beat JSON data."""
+    if isinstance(file_path, DecodedAudio):
+        # BeatNet works on 22.05 kHz mono and takes the samples directly
+        audio = file_path.view(BEATNET_SAMPLE_RATE, 1)
+    else:
+        # BeatNet loads the file itself
+        audio = file_path
+
     try:
-        audio_data, sample_rate = librosa.load(file_path, sr=None)
+        estimator = registry.get("beatnet")
+        with estimator_lock, measure("beatnet", audio_duration(file_path)):
+            output = estimator.process(audio)
     except Exception as e:
-        raise Exception(f"Error loading audio: {str(e)}")
-
-    output = estimator.process(file_path)
+        raise Exception(f"Error analyzing beats: {str(e)}")
     # convert the output to the right structure
     beat_json_array = []
     for key,value in output:
@@ -35,18 +55,23 @@ async def analyze_beat(file_path: str):
 
     return beat_json_array
 
+async def analyze_beat(file_path: Union[str, DecodedAudio]):
+    """Process the audio file at the given path (or already decoded audio) and return beat JSON data."""
+    return await run_inference("beatnet", analyze_beat_sync, file_path)
+
 @app.post("/detect-beats/")
 async def detect_beats(file: UploadFile):
+    audio_path = None
     try:
         # Ensure the uploaded file is audio
         if not file.content_type.startswith("audio/"):
             raise HTTPException(status_code=400, detail="Invalid file type. Please upload an audio file.")
 
-        # Save the uploaded file to a temporary path
+        # Spool the uploaded file to disk in chunks
         try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-                tmp.write(await file.read())
-                audio_path = tmp.name
+            audio_path = (await spool_upload(file, suffix=".wav")).path
+        except HTTPException:
+            raise
         except Exception as e:
             traceback.print_exc()
             raise HTTPException(status_code=500, detail=f"Error saving audio file: {str(e)}")
@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import numpy as np
+import soundfile as sf
+import torch
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from benchmarks import signals
+from beat_detection import analyze_beat_sync
+from decoded_audio import DecodedAudio
+from model_registry import registry
+from payload import encode_json_and_file
+from timeline import build_timeline
+from timestamped_transcription import transcribe_file_sync
+from transcribe_visemes import transcribe_visemes_sync
+from vocal_remover.lib import nets
+from vocal_remover.lib import spec_utils
+from vocal_remover.inference import Separator
+
+DEFAULT_MODEL_PATH = os.path.join(ROOT, 'models', 'baseline.pth')
+STAGES = ['stft', 'istft', 'separate', 'separate_tta', 'visemes', 'words', 'beats', 'timeline', 'encode']
+
+
+class PeakRss(object):
+    """Samples the resident set size while a stage runs and keeps the highest value, in bytes."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            # no procfs, fall back to the lifetime peak (kB on Linux, bytes on macOS)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == 'darwin' else peak * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def time_stage(function, audio_seconds, repeat, warmup):
+    for _ in range(warmup):
+        function()
+
+    walls, cpus = [], []
+    with PeakRss() as rss:
+        for _ in range(repeat):
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            function()
+            walls.append(time.perf_counter() - wall)
+            cpus.append(time.process_time() - cpu)
+
+    median = statistics.median(walls)
+    return {
+        'audio_seconds': audio_seconds,
+        'repeat': repeat,
+        'wall_median': median,
+        'wall_min': min(walls),
+        'wall_mean': statistics.mean(walls),
+        'cpu_median': statistics.median(cpus),
+        'real_time_factor': median / audio_seconds,
+        'peak_rss_mb': rss.peak / (1024 * 1024),
+    }
+
+
+def load_separation_model(path, n_fft, hop_length):
+    # without the pretrained weights time the same network with deterministic random ones
+    torch.manual_seed(0)
+    model = nets.CascadedNet(n_fft, hop_length, 32, 128)
+    weights = 'random'
+    if os.path.exists(path):
+        model.load_state_dict(torch.load(path, map_location='cpu'))
+        weights = path
+    model.eval()
+    return model, weights
+
+
+def synthetic_timeline_inputs(seconds):
+    # result shapes of BeatNet, Whisper and Allosaurus at typical densities for a song of this length
+    beats = [{'time': int(t * 1000), 'data': float(i % 4 + 1), 'type': 'BEAT'} for i, t in enumerate(np.arange(0.5, seconds, 0.5))]
+    words = [{'word': f' word{i}', 'start': str(t), 'end': str(t + 0.3)} for i, t in enumerate(np.arange(1.0, seconds, 0.4))]
+    phonemes = [
+        {'phoneme': 'a', 'viseme': 'aa', 'start_time': t, 'end_time': t + 0.06}
+        for t in np.arange(1.0, seconds, 0.08)
+    ]
+    return beats, words, {'transcription': phonemes}
+
+
+def benchmark(args):
+    stages = args.stages or STAGES
+    sr = args.sr
+    results = {}
+
+    def run(name, function, audio_seconds):
+        if name not in stages or name in results:
+            return
+        print(f'{name}...', end=' ', flush=True)
+        try:
+            results[name] = time_stage(function, audio_seconds, args.repeat, args.warmup)
+            print(f"{results[name]['wall_median']:.3f}s (rtf {results[name]['real_time_factor']:.3f})")
+        except Exception as e:
+            traceback.print_exc()
+            results[name] = {'skipped': str(e)}
+            print(f'skipped: {e}')
+
+    def skip(name, reason):
+        results[name] = {'skipped': reason}
+        print(f'{name}... skipped: {reason}')
+
+    seconds = args.seconds
+    X = signals.mixture(seconds, sr)
+    speech = signals.speech_like(seconds, 16000)
+
+    # spectrogram transforms and separation, on the same settings get_vocals uses
+    X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft, args.stft_backend)
+    run('stft', lambda: spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft, args.stft_backend), seconds)
+    run('istft', lambda: spec_utils.spectrogram_to_wave(X_spec, hop_length=args.hop_length, backend=args.stft_backend), seconds)
+
+    model, weights = load_separation_model(args.pretrained_model, args.n_fft, args.hop_length)
+    separator = Separator(model=model, device=torch.device('cpu'), batchsize=args.batchsize, cropsize=args.cropsize)
+    run('separate', lambda: separator.separate(X_spec), seconds)
+    run('separate_tta', lambda: separator.separate_tta(X_spec), seconds)
+
+    # the recognizers need their models downloaded or a network connection, skip the ones that can't load
+    for name, model_name in (('visemes', 'allosaurus'), ('words', 'whisper'), ('beats', 'beatnet')):
+        if name in stages:
+            try:
+                registry.get(model_name)
+            except Exception as e:
+                skip(name, f'{model_name} unavailable: {e}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        speech_path = os.path.join(tmp, 'speech.wav')
+        sf.write(speech_path, speech, 16000)
+        run('visemes', lambda: transcribe_visemes_sync(speech_path), seconds)
+        run('words', lambda: transcribe_file_sync(speech_path), seconds)
+
+    clicks = DecodedAudio(signals.click_track(seconds, sr) + 0.3 * signals.tones(seconds, sr), sr, 'clicks')
+    run('beats', lambda: analyze_beat_sync(clicks), seconds)
+
+    # timeline assembly and response encoding, as /analyze/ does them after the models
+    beats, words, visemes = synthetic_timeline_inputs(seconds)
+    run('timeline', lambda: build_timeline(beats, words, visemes, 24000, 1).to_dicts(), seconds)
+
+    mix = DecodedAudio(X, sr, 'mix')
+    data = build_timeline(beats, words, visemes, 24000, 1).to_dicts()
+    mix.view(24000, 1)  # resampling is cached per request, time the encoding itself
+    run('encode', lambda: encode_json_and_file(data, mix, output_format='pcm', sample_rate=24000, channels=1), seconds)
+
+    return {
+        'config': {
+            'seconds': seconds,
+            'sr': sr,
+            'n_fft': args.n_fft,
+            'hop_length': args.hop_length,
+            'batchsize': args.batchsize,
+            'cropsize': args.cropsize,
+            'stft_backend': args.stft_backend,
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'weights': weights,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads(),
+        },
+        'stages': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the median wall time of every stage against the baseline. Returns the stages that regressed."""
+    regressions = []
+    print(f"{'stage':<14}{'baseline':>12}{'current':>12}{'ratio':>10}")
+    for name, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if 'wall_median' not in current or not previous or 'wall_median' not in previous:
+            continue
+        ratio = current['wall_median'] / previous['wall_median']
+        flag = ' REGRESSION' if ratio > threshold else ''
+        print(f"{name:<14}{previous['wall_median']:>11.3f}s{current['wall_median']:>11.3f}s{ratio:>10.2f}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    p = argparse.ArgumentParser(description='Time every analysis stage on deterministic synthetic audio.')
+    p.add_argument('--seconds', '-s', type=float, default=30.0)
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--hop_length', '-H', type=int, default=512)
+    p.add_argument('--batchsize', '-B', type=int, default=4)
+    p.add_argument('--cropsize', '-c', type=int, default=512)
+    p.add_argument('--stft_backend', choices=spec_utils.STFT_BACKENDS, default='librosa')
+    p.add_argument('--pretrained_model', '-P', type=str, default=DEFAULT_MODEL_PATH)
+    p.add_argument('--repeat', '-n', type=int, default=3)
+    p.add_argument('--warmup', '-w', type=int, default=1)
+    p.add_argument('--stages', nargs='+', choices=STAGES)
+    p.add_argument('--output', '-o', type=str, default='')
+    p.add_argument('--baseline', '-b', type=str, default='')
+    p.add_argument('--threshold', '-t', type=float, default=1.1, help='slowdown ratio reported as a regression')
+    args = p.parse_args()
+
+    results = benchmark(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'wrote {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
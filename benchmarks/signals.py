@@ -0,0 +1,69 @@
+import numpy as np
+
+# Deterministic synthetic inputs for the benchmarks. Every generator takes a duration and a sample rate and
+# returns float32 samples in [-1, 1], seeded so repeated runs time the same audio.
+
+
+def tones(seconds, sr=44100, frequencies=(220.0, 277.2, 329.6, 440.0)):
+    # a sustained chord, one sine per frequency
+    t = np.arange(int(seconds * sr)) / sr
+    wave = sum(np.sin(2 * np.pi * f * t) for f in frequencies)
+    return (0.5 * wave / len(frequencies)).astype(np.float32)
+
+
+def noise(seconds, sr=44100, seed=0, level=0.1):
+    rng = np.random.default_rng(seed)
+    return (level * rng.standard_normal(int(seconds * sr))).astype(np.float32)
+
+
+def speech_like(seconds, sr=44100, seed=1, syllable_rate=4.0):
+    """
+    A harmonic source with a wandering pitch, shaped by two formant-like resonances and gated into syllables
+    with pauses, which gives the recognizers and the separator something voice-like to work on.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sr)
+    t = np.arange(n) / sr
+
+    # pitch drifts around 140 Hz, phase is the running sum of the instantaneous frequency
+    f0 = 140 + 30 * np.sin(2 * np.pi * 0.3 * t) + 10 * np.sin(2 * np.pi * 2.1 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    formants = (0.5 + 0.5 * np.sin(2 * np.pi * 1.7 * t), 0.5 + 0.5 * np.cos(2 * np.pi * 2.3 * t))
+    voice = np.zeros(n)
+    for harmonic in range(1, 16):
+        # harmonics near 700 Hz and 1200 Hz are louder, moving with the formant envelopes
+        frequency = harmonic * 140
+        weight = formants[0] * np.exp(-((frequency - 700) / 300) ** 2) + formants[1] * np.exp(-((frequency - 1200) / 400) ** 2)
+        voice += (0.2 + weight) * np.sin(harmonic * phase) / harmonic
+
+    # syllable envelope with a pause of silence roughly every 2 seconds
+    syllables = np.clip(np.sin(np.pi * syllable_rate * t), 0, None) ** 2
+    pauses = np.repeat(rng.random(int(np.ceil(seconds / 2)) + 1) > 0.3, 2 * sr)[:n]
+    wave = voice * syllables * pauses
+    peak = np.abs(wave).max()
+    return (0.8 * wave / peak if peak else wave).astype(np.float32)
+
+
+def click_track(seconds, sr=44100, bpm=120.0, click_seconds=0.01):
+    # short decaying 1 kHz clicks on every beat, accented on the first beat of each bar
+    n = int(seconds * sr)
+    wave = np.zeros(n, dtype=np.float32)
+    length = int(click_seconds * sr)
+    t = np.arange(length) / sr
+    click = (np.sin(2 * np.pi * 1000 * t) * np.exp(-t / (click_seconds / 4))).astype(np.float32)
+    for i, start in enumerate(np.arange(0, n, 60.0 / bpm * sr).astype(int)):
+        end = min(n, start + length)
+        wave[start:end] += (0.9 if i % 4 == 0 else 0.5) * click[:end - start]
+    return wave
+
+
+def mixture(seconds, sr=44100):
+    """Stereo song-like mix of all of the above, (2, samples)."""
+    voice = speech_like(seconds, sr)
+    backing = 0.4 * tones(seconds, sr) + 0.5 * click_track(seconds, sr) + noise(seconds, sr, level=0.02)
+    # pan the backing a little so the channels differ
+    left = voice + 0.8 * backing
+    right = voice + 0.6 * backing + noise(seconds, sr, seed=2, level=0.01)
+    wave = np.stack([left, right])
+    return (0.9 * wave / np.abs(wave).max()).astype(np.float32)
+
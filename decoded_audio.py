@@ -0,0 +1,89 @@
+import threading
+from io import BytesIO
+
+import librosa
+import numpy as np
+from pydub import AudioSegment
+
+
+class DecodedAudio(object):
+    """
+    Audio decoded once into a float32 (channels, samples) buffer. Every stage asks for the rate and channel
+    count it wants with view(), which resamples and remixes on first use and caches the result.
+    """
+
+    def __init__(self, samples, sample_rate, name=None):
+        samples = np.asarray(samples, dtype=np.float32)
+        if samples.ndim == 1:
+            samples = samples[None, :]
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.name = name
+        self._views = {(sample_rate, samples.shape[0]): samples}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_segment(cls, segment, name=None):
+        # pydub keeps interleaved integer samples, scale them to [-1, 1)
+        samples = np.array(segment.get_array_of_samples(), dtype=np.float32)
+        samples /= float(1 << (8 * segment.sample_width - 1))
+        samples = samples.reshape(-1, segment.channels).T
+        return cls(samples, segment.frame_rate, name)
+
+    @classmethod
+    def from_bytes(cls, content, name=None):
+        return cls.from_segment(AudioSegment.from_file(BytesIO(content)), name)
+
+    @classmethod
+    def from_file(cls, path, name=None):
+        return cls.from_segment(AudioSegment.from_file(path), name)
+
+    @property
+    def channels(self):
+        return self.samples.shape[0]
+
+    @property
+    def duration(self):
+        return self.samples.shape[1] / self.sample_rate
+
+    def view(self, sample_rate=None, channels=None):
+        """
+        The audio at `sample_rate` with `channels` channels as a (channels, samples) float32 array, except for
+        mono which is a flat array the way librosa and the recognizers expect it. Don't write to the result,
+        it is shared.
+        """
+        sample_rate = sample_rate or self.sample_rate
+        channels = channels or self.channels
+        key = (sample_rate, channels)
+
+        with self._lock:
+            view = self._views.get(key)
+            if view is None:
+                # remix at the source rate first (cached too), then resample the remixed audio
+                view = self._remix(channels)
+                if sample_rate != self.sample_rate:
+                    view = librosa.resample(view, orig_sr=self.sample_rate, target_sr=sample_rate).astype(np.float32, copy=False)
+                self._views[key] = view
+
+        return view[0] if channels == 1 else view
+
+    def _remix(self, channels):
+        key = (self.sample_rate, channels)
+        if key in self._views:
+            return self._views[key]
+
+        if channels == 1:
+            view = self.samples.mean(axis=0, keepdims=True)
+        elif self.channels == 1:
+            view = np.repeat(self.samples, channels, axis=0)
+        else:
+            view = self.samples[:channels]
+        self._views[key] = view
+        return view
+
+    def to_pcm16(self, sample_rate=None, channels=None):
+        # interleaved little-endian 16-bit PCM bytes
+        view = self.view(sample_rate, channels)
+        if view.ndim > 1:
+            view = view.T
+        return (np.clip(view, -1.0, 1.0) * 32767).astype('<i2').tobytes()
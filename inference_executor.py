@@ -0,0 +1,40 @@
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Worker threads per model type. Jobs for a model type queue in arrival order on its own pool, so a long
+# separation never holds up beat tracking for another request and the event loop itself never blocks.
+POOL_SIZES = {
+    "separation": int(os.environ.get("LIPSYNC_SEPARATION_WORKERS", 1)),
+    "whisper": int(os.environ.get("LIPSYNC_WHISPER_WORKERS", 1)),
+    "allosaurus": int(os.environ.get("LIPSYNC_ALLOSAURUS_WORKERS", 1)),
+    "beatnet": int(os.environ.get("LIPSYNC_BEATNET_WORKERS", 1)),
+}
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(model_type):
+    with _executors_lock:
+        if model_type not in _executors:
+            _executors[model_type] = ThreadPoolExecutor(
+                max_workers=POOL_SIZES.get(model_type, 1),
+                thread_name_prefix=f"inference-{model_type}"
+            )
+        return _executors[model_type]
+
+
+async def run_inference(model_type, function, *args, **kwargs):
+    """Run a blocking model call on the pool for its model type and wait for it without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(model_type), functools.partial(function, *args, **kwargs))
+
+
+def shutdown():
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        _executors.clear()
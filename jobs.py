@@ -0,0 +1,128 @@
+import asyncio
+import time
+import traceback
+import uuid
+
+from app import log
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job(object):
+
+    def __init__(self, job_id, function, args, params=None, on_expire=None):
+        self.id = job_id
+        self.function = function
+        self.args = args
+        self.params = params or {}
+        self.on_expire = on_expire
+        self.status = "queued"
+        self.stages = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def stage_started(self, name):
+        self.stages[name] = {"status": "running"}
+
+    def stage_finished(self, name, duration, result=None):
+        self.stages[name] = {"status": "done", "duration": duration}
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stages": self.stages,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobQueue(object):
+    """
+    Bounded in-process work queue. A fixed number of workers pull jobs in submission order, so the number of
+    songs analyzed at once stays constant no matter how many are submitted.
+    """
+
+    def __init__(self, workers=2, max_queued=64, retention=3600):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.retention = retention
+        self.jobs = {}
+        self._queue = None
+        self._tasks = []
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queued)
+            self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, function, *args, params=None, on_expire=None):
+        """Queue `await function(job, *args)` and return the job. Raises QueueFullError when the queue is full."""
+        self._start()
+        self._expire()
+
+        job = Job(uuid.uuid4().hex, function, args, params, on_expire)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Job queue is full ({self.max_queued} jobs waiting)")
+
+        self.jobs[job.id] = job
+        log("jobs", f"Queued job {job.id} ({self._queue.qsize()} waiting)")
+        return job
+
+    def get(self, job_id):
+        self._expire()
+        return self.jobs.get(job_id)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            job.started = time.time()
+            try:
+                job.result = await job.function(job, *job.args)
+                job.status = "done"
+                log("jobs", f"Job {job.id} finished in {time.time() - job.started:.2f}s")
+            except Exception as e:
+                traceback.print_exc()
+                job.status = "failed"
+                job.error = str(e)
+                log("jobs", f"Job {job.id} failed: {str(e)}")
+            finally:
+                # drop the inputs so finished jobs don't keep large arguments alive
+                job.args = ()
+                job.finished = time.time()
+                self._queue.task_done()
+
+    def _expire(self):
+        # forget finished jobs once their results have been around for longer than the retention period
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished is not None and now - job.finished > self.retention:
+                del self.jobs[job_id]
+                self._cleanup(job)
+
+    @staticmethod
+    def _cleanup(job):
+        if job.on_expire:
+            try:
+                job.on_expire()
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._queue = None
+        for job in self.jobs.values():
+            self._cleanup(job)
+        self.jobs.clear()
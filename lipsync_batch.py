@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac', '.ogg', '.m4a', '.aac', '.aiff', '.aif', '.opus', '.wma')
+MANIFEST_NAME = 'manifest.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def find_songs(input_dir, output_dir):
+    # every audio file under input_dir by its path relative to it, leaving out anything inside the output
+    output_dir = os.path.abspath(output_dir)
+    songs = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != output_dir)
+        for name in sorted(files):
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                songs.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return songs
+
+
+def file_hash(path):
+    content_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get('files', {})
+
+
+def write_manifest(path, files):
+    # write and rename so an interrupted run never leaves a half written manifest to resume from
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump({'updated': time.time(), 'files': files}, f, indent=2, sort_keys=True)
+    os.replace(f'{path}.tmp', path)
+
+
+def output_path(output_dir, song, timeline_format):
+    return os.path.join(output_dir, os.path.splitext(song)[0] + ('.bin' if timeline_format == 'binary' else '.json'))
+
+
+def is_done(entry, content_hash, settings, output_dir):
+    # a result only counts for the same content analyzed with the same settings
+    return (
+        entry is not None and entry.get('status') == 'done' and entry.get('hash') == content_hash
+        and entry.get('settings') == settings and os.path.exists(os.path.join(output_dir, entry['output']))
+    )
+
+
+def init_worker(pretrained_model, torch_threads):
+    # runs once in every worker process, the registry then keeps each model loaded for every song of the worker
+    import torch
+    import vocal_remover.api
+
+    torch.set_num_threads(torch_threads)
+    vocal_remover.api.SEPARATION_MODEL_PATH = pretrained_model
+    import main  # noqa: F401, registers the model loaders of every stage
+
+
+def analyze_song(path, destination, sample_rate, channels, stages, timeline_format):
+    """Run the /analyze/ pipeline on one song in a worker process and write its timeline. Returns the stage timings."""
+    import main
+    from payload import encode_timeline
+
+    start = time.perf_counter()
+    audio, audio_hash = main.decode_upload(path)
+    data, timings = asyncio.run(
+        main.get_timeline(audio, audio_hash, sample_rate=sample_rate, channels=channels, stages=stages)
+    )
+
+    if timeline_format == 'binary':
+        content, _ = encode_timeline(data, sample_rate, channels, timeline_format)
+    else:
+        content = json.dumps(data).encode('utf-8')
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+    with open(f'{destination}.tmp', 'wb') as f:
+        f.write(content)
+    os.replace(f'{destination}.tmp', destination)
+    return {'timings': timings, 'wall': time.perf_counter() - start, 'duration': audio.duration, 'events': len(data)}
+
+
+def main():
+    p = argparse.ArgumentParser(description='Analyze every song in a directory with the same pipeline as /analyze/.')
+    p.add_argument('input_dir')
+    p.add_argument('--output_dir', '-o', type=str, default='', help='defaults to <input_dir>/lipsync')
+    p.add_argument('--workers', '-j', type=int, default=max(1, (os.cpu_count() or 1) // 4))
+    p.add_argument('--sample_rate', '-r', type=int, default=24000)
+    p.add_argument('--channels', '-C', type=int, default=1)
+    p.add_argument('--stages', type=str, default='', help='comma separated subset of visemes,words,beats,emotes')
+    p.add_argument('--timeline_format', '-F', choices=('json', 'binary'), default='json')
+    p.add_argument('--pretrained_model', '-P', type=str, default=os.environ.get('LIPSYNC_SEPARATION_MODEL', ''))
+    p.add_argument('--force', action='store_true', help='analyze songs that already have a result again')
+    args = p.parse_args()
+
+    output_dir = args.output_dir or os.path.join(args.input_dir, 'lipsync')
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+
+    from timeline import TIMELINE_STAGES
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()] or None
+    unknown = set(stages or ()).difference(TIMELINE_STAGES)
+    if unknown:
+        p.error(f"unknown stages {', '.join(sorted(unknown))}, available: {', '.join(TIMELINE_STAGES)}")
+    pretrained_model = args.pretrained_model
+    if not pretrained_model:
+        from vocal_remover.inference import DEFAULT_MODEL_PATH
+        pretrained_model = DEFAULT_MODEL_PATH
+    settings = {
+        'sample_rate': args.sample_rate,
+        'channels': args.channels,
+        'stages': sorted(stages) if stages else None,
+        'timeline_format': args.timeline_format,
+        'pretrained_model': os.path.abspath(pretrained_model),
+    }
+
+    # resume: songs whose content already has a result are skipped, copies of a finished song reuse its result
+    finished = {
+        entry['hash']: entry for entry in manifest.values() if is_done(entry, entry.get('hash'), settings, output_dir)
+    }
+    pending = {}
+    copies = {}
+    skipped = 0
+    for song in find_songs(args.input_dir, output_dir):
+        content_hash = file_hash(os.path.join(args.input_dir, song))
+        if not args.force and is_done(manifest.get(song), content_hash, settings, output_dir):
+            skipped += 1
+        elif not args.force and content_hash in finished:
+            manifest[song] = dict(finished[content_hash], reused=True)
+            skipped += 1
+        elif content_hash in pending.values():
+            copies[song] = content_hash
+        else:
+            pending[song] = content_hash
+
+    print(f'{len(pending)} songs to analyze, {len(copies)} copies of them, {skipped} already done, {args.workers} workers')
+    if not pending:
+        write_manifest(manifest_path, manifest)
+        return
+
+    # torch gets the cores left per worker, so the workers together use every core without oversubscribing
+    torch_threads = max(1, (os.cpu_count() or 1) // args.workers)
+    failed = 0
+    start = time.time()
+    with ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(pretrained_model, torch_threads)
+    ) as pool:
+        futures = {}
+        for song, content_hash in pending.items():
+            destination = output_path(output_dir, song, args.timeline_format)
+            future = pool.submit(
+                analyze_song, os.path.join(args.input_dir, song), destination, args.sample_rate, args.channels,
+                stages, args.timeline_format
+            )
+            futures[future] = (song, content_hash, destination)
+
+        for done, future in enumerate(as_completed(futures), 1):
+            song, content_hash, destination = futures[future]
+            entry = {
+                'hash': content_hash,
+                'settings': settings,
+                'output': os.path.relpath(destination, output_dir),
+                'finished': time.time(),
+            }
+            try:
+                entry.update(future.result(), status='done')
+                print(f'[{done}/{len(futures)}] {song}: {entry["duration"]:.0f}s of audio in {entry["wall"]:.1f}s, {entry["events"]} events')
+            except Exception as e:
+                traceback.print_exc()
+                failed += 1
+                entry.update(status='failed', error=str(e))
+                print(f'[{done}/{len(futures)}] {song}: failed: {e}')
+            manifest[song] = entry
+            for copy, copy_hash in copies.items():
+                if copy_hash == content_hash:
+                    manifest[copy] = dict(entry, reused=True)
+            write_manifest(manifest_path, manifest)
+
+    print(f'done in {time.time() - start:.1f}s, {failed} failed, manifest in {manifest_path}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,72 +1,226 @@
-import base64
+import argparse
+import asyncio
+import os
+import shutil
 import sys
+import time
 import traceback
+import uuid
+import zipfile
 
-from app import app, encode_json_and_file, log
+from app import app, log
 import tempfile
-from fastapi import UploadFile, File, Form, Request
+from fastapi import UploadFile, File, Form, Request, HTTPException
 from typing import List, Dict, Union, Optional
-from timestamped_transcription import transcribe_file
-from transcribe_visemes import transcribe_visemes
+from timestamped_transcription import transcribe_files, transcribe_wave
+from transcribe_visemes import model_name, transcribe_visemes_wave
 import wave
 import struct
 import json
 from io import BytesIO
 from pydub import AudioSegment
 from vocal_remover.api import *
+import vocal_remover.api
 import uvicorn
 from beat_detection import *
 from fastapi.responses import StreamingResponse, JSONResponse
+from result_cache import ResultCache, hash_audio
+from decoded_audio import DecodedAudio
+import inference_executor
+from jobs import JobQueue, QueueFullError
+from timeline import TIMELINE_STAGES, Timeline, build_timeline
+from uploads import MAX_UPLOAD_BYTES, MAX_UPLOAD_SECONDS, PROBE_BYTES, UPLOADS_DIR, check_duration, probe_header_duration, spool_upload
+from vocal_activity import ACTIVITY_OFF_DB, ACTIVITY_ON_DB
+from metrics import measure
+from payload import encode_json_and_file, iter_encoded, iter_json_with_payload
+from model_registry import registry, start_warmup
 
-def encode_json_and_file(json_data, audio_path, output_format="pcm", sample_rate=24000, channels=1):
-    FLAG_SIZE = 1
-    LONG_SIZE = 8
-
-    # Convert JSON data to a byte array
-    json_bytes = json.dumps(json_data).encode('utf-8') if json_data else b''
-    json_length = len(json_bytes)
-
-    # Read and convert the audio file content based on the requested format
-    audio = AudioSegment.from_file(audio_path)
-    if output_format == "wav":
-        audio = audio.set_frame_rate(sample_rate).set_sample_width(2).set_channels(channels)
-        file_bytes = audio.export(format="wav").read()
-    elif output_format == "mp3":
-        audio = audio.set_frame_rate(sample_rate).set_sample_width(2).set_channels(channels)
-        file_bytes = audio.export(format="mp3").read()
-    else:  # default to pcm
-        # reencode the audio to PCM with 16k sample rate, 16-bit sample width, and mono channel
-        audio = audio.set_frame_rate(sample_rate).set_sample_width(2).set_channels(channels)
-        file_bytes = audio.raw_data
-
-    binary_length = len(file_bytes)
-
-    # Set flags
-    has_binary = 1 if binary_length > 0 else 0
-    has_json = 1 if json_length > 0 else 0
-
-    # Create the flag byte
-    flags = (has_binary | (has_json << 1))
-
-    # Construct the byte array with header
-    header = struct.pack(
-        f'B{LONG_SIZE}s{LONG_SIZE}s',
-        flags,
-        struct.pack('q', json_length),  # 'q' is for 8-byte signed long
-        struct.pack('q', binary_length)  # 'q' for 8-byte signed long
+# Finished timelines keyed by the decoded audio plus everything that changes the output
+result_cache = ResultCache(
+    cache_dir=os.environ.get("LIPSYNC_CACHE_DIR", "cache"),
+    max_memory_items=int(os.environ.get("LIPSYNC_CACHE_MEMORY_ITEMS", 64)),
+    max_disk_bytes=int(os.environ.get("LIPSYNC_CACHE_DISK_MB", 512)) * 1024 * 1024,
+    ttl=int(os.environ.get("LIPSYNC_CACHE_TTL", 7 * 24 * 3600))
+)
+
+# Model settings that change the output, part of every cache key
+RESULT_CACHE_PARAMS = {
+    "n_fft": 2048,
+    "hop_length": 512,
+    "phoneme_model": model_name,
+    # the recognizers get the vocals at their own rate, straight from the separation
+    "asr_sample_rate": vocal_remover.api.ASR_SAMPLE_RATE,
+}
+
+
+def result_cache_params(whisper_model=None, vocal_model=None):
+    # the separation weights can be set on the command line or replaced on disk, so look them up for every key
+    path = os.path.abspath(vocal_remover.api.separation_models()[registry.resolve("separation", vocal_model)])
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+    return dict(
+        RESULT_CACHE_PARAMS,
+        whisper_model=registry.resolve("whisper", whisper_model),
+        vocal_model=path,
+        vocal_model_mtime=mtime,
+        silence_threshold=vocal_remover.api.SEPARATION_SILENCE_THRESHOLD,
+        activity_db=(ACTIVITY_ON_DB, ACTIVITY_OFF_DB)
+    )
+
+
+def check_models(whisper_model=None, vocal_model=None):
+    # reject unknown model names before any work is done
+    try:
+        registry.resolve("whisper", whisper_model)
+        registry.resolve("separation", vocal_model)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# Encoded results of finished jobs wait here until they are fetched or expire
+JOB_PAYLOAD_DIR = os.environ.get("LIPSYNC_JOB_DIR", "jobs")
+
+# Songs submitted through /jobs/ are analyzed in the background by a fixed number of workers
+job_queue = JobQueue(
+    workers=int(os.environ.get("LIPSYNC_JOB_WORKERS", 2)),
+    max_queued=int(os.environ.get("LIPSYNC_JOB_QUEUE", 64)),
+    retention=int(os.environ.get("LIPSYNC_JOB_RETENTION", 3600))
+)
+
+app.on_event("shutdown")(job_queue.stop)
+app.on_event("shutdown")(inference_executor.shutdown)
+
+async def run_stages(stages, progress=None):
+    """
+    Run a {name: (dependencies, async function)} stage graph. Each stage starts as soon as its dependencies
+    finish and receives their results as arguments. Returns the results and per-stage timings.
+    `progress` (a Job for example) is told when each stage starts and finishes, along with the stage result.
+    """
+    tasks = {}
+    timings = {}
+
+    async def run(name):
+        dependencies, function = stages[name]
+        inputs = [await tasks[dependency] for dependency in dependencies]
+        log("analyze", f"Starting stage {name}...")
+        if progress:
+            progress.stage_started(name)
+        start = time.perf_counter()
+        result = await function(*inputs)
+        timings[name] = time.perf_counter() - start
+        log("analyze", f"Stage {name} finished in {timings[name]:.2f}s")
+        if progress:
+            progress.stage_finished(name, timings[name], result)
+        return result
+
+    for name in stages:
+        tasks[name] = asyncio.ensure_future(run(name))
+
+    try:
+        results = await asyncio.gather(*tasks.values())
+    except Exception:
+        for task in tasks.values():
+            task.cancel()
+        raise
+
+    return dict(zip(tasks.keys(), results)), timings
+
+
+async def analyze_audio(audio, transcript=None, sample_rate=24000, channels=1, progress=None, whisper_model=None, vocal_model=None, stages=None):
+    # Beat tracking only needs the mixture so it runs alongside separation, both recognizers only need the vocals.
+    # Both mixture stages read the shared decoded audio instead of decoding a file again.
+    # Separation also tells where the vocals are active: the emotes follow it and the recognizers skip the rest.
+    # Models nothing in `stages` needs don't run: Whisper only for words, Allosaurus only for visemes.
+    stages = TIMELINE_STAGES if stages is None else stages
+    model_stages = {}
+    if "words" in stages:
+        model_stages["words"] = (("vocals", "activity"), lambda vocals, activity: transcribe_wave(vocals.wave("vocals"), transcript, whisper_model, activity))
+    if "visemes" in stages:
+        model_stages["visemes"] = (("vocals", "activity"), lambda vocals, activity: transcribe_visemes_wave(vocals.wave("vocals"), activity, vocals.sample_rates["vocals"]))
+    if model_stages or "emotes" in stages:
+        model_stages["vocals"] = ((), lambda: separate_vocals(audio, vocal_model, n_fft=RESULT_CACHE_PARAMS["n_fft"], hop_length=RESULT_CACHE_PARAMS["hop_length"], activity=True, stems=("vocals",), asr=True, write=False))
+        model_stages["activity"] = (("vocals",), lambda vocals: asyncio.to_thread(vocals.activity))
+    if "beats" in stages:
+        model_stages["beats"] = ((), lambda: analyze_beat(audio))
+
+    results, timings = await run_stages(model_stages, progress)
+
+    log("analyze", "Combining data...")
+    with measure("timeline", audio.duration):
+        data = build_timeline(
+            results.get("beats"), results.get("words"), results.get("visemes"), sample_rate, channels, stages,
+            results.get("activity")
+        ).to_dicts()
+
+    return data, timings
+
+
+def parse_stages(value):
+    # "visemes,words" to the set of requested stages, None (every stage) when not set
+    if not value:
+        return None
+    stages = {stage.strip() for stage in value.split(",") if stage.strip()}
+    unknown = stages.difference(TIMELINE_STAGES)
+    if unknown or not stages:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown stages {', '.join(sorted(unknown))}, available: {', '.join(TIMELINE_STAGES)}"
+        )
+    return stages
+
+
+def format_server_timing(timings):
+    # Server-Timing header value, durations in milliseconds
+    return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in timings.items())
+
+
+def decode_upload(path):
+    with measure("decode") as sample:
+        segment = AudioSegment.from_file(path)
+        # hash the audio itself rather than the file name
+        audio_hash = hash_audio(segment.raw_data, segment.frame_rate, segment.channels, segment.sample_width)
+        audio = DecodedAudio.from_segment(segment, name=audio_hash)
+        sample["audio_seconds"] = audio.duration
+    return audio, audio_hash
+
+
+async def store_upload(file: UploadFile):
+    """Decode an upload once for every stage. Returns the DecodedAudio and the hash of the audio."""
+    # spool to disk first so size and duration limits apply before anything is decoded
+    with await spool_upload(file) as upload:
+        os.makedirs('output_vocals', exist_ok=True)
+        return await asyncio.to_thread(decode_upload, upload.path)
+
+
+def timeline_cache_key(audio_hash, transcript=None, sample_rate=24000, channels=1, whisper_model=None, vocal_model=None, stages=None, batch=False):
+    # /analyze-batch/ gives Whisper the whole clip packed with others rather than its voiced segments, so its
+    # timelines are kept apart from the /analyze/ ones
+    batch_params = {"whisper_packing": True} if batch else {}
+    return result_cache.make_key(
+        audio_hash,
+        transcript=transcript,
+        sample_rate=sample_rate,
+        channels=channels,
+        stages=sorted(TIMELINE_STAGES if stages is None else stages),
+        **batch_params,
+        **result_cache_params(whisper_model, vocal_model)
     )
 
-    # Concatenate header, JSON bytes, and file bytes
-    encoded_data = header + json_bytes + file_bytes
 
-    return encoded_data
+async def get_timeline(audio, audio_hash, transcript=None, sample_rate=24000, channels=1, progress=None, whisper_model=None, vocal_model=None, stages=None):
+    """Return the timeline for the decoded audio and the stage timings, from the result cache when possible."""
+    cache_key = timeline_cache_key(audio_hash, transcript, sample_rate, channels, whisper_model, vocal_model, stages)
+    data = result_cache.get(cache_key)
+    if data is not None:
+        log("analyze", f"Using cached result for {audio_hash}")
+        return data, {}
+
+    data, timings = await analyze_audio(audio, transcript, sample_rate, channels, progress, whisper_model, vocal_model, stages)
+    result_cache.put(cache_key, data)
+    return data, timings
+
+
+def output_media_type(output_format):
+    return "audio/wav" if output_format == "wav" else "audio/mpeg" if output_format == "mp3" else "application/octet-stream"
 
-# function to convert float timestamp to ms. Multiply by 1000 and round then convert to string
-def convert_to_ms(timestamp):
-    # if timestamp is a string convert to float
-    if isinstance(timestamp, str):
-        timestamp = float(timestamp)
-    return int(timestamp * 1000)
 
 @app.post("/analyze/")
 async def process_audio(
@@ -76,194 +230,475 @@ async def process_audio(
         output_format: Optional[str] = Form("pcm"),  # Specify output format: pcm, wav, mp3
         include_base64: Optional[bool] = Form(False),  # Include base64 encoded audio in JSON response
         sample_rate: Optional[int] = Form(24000),  # Specify the sample rate for the audio
-        channels: Optional[int] = Form(1)  # Specify the number of channels for the audio
+        channels: Optional[int] = Form(1),  # Specify the number of channels for the audio
+        timeline_format: Optional[str] = Form("json"),  # Timeline encoding in the binary payload: json, binary
+        whisper_model: Optional[str] = Form(None),  # Whisper model size, the server default when not set
+        vocal_model: Optional[str] = Form(None),  # Separation checkpoint name, the server default when not set
+        stages: Optional[str] = Form(None)  # Comma separated subset of visemes,words,beats,emotes, all when not set
 ):
     log("analyze", f"Received file {file.filename}")
+    check_models(whisper_model, vocal_model)
+    stages = parse_stages(stages)
     try:
-        # get a name for the file based on the md5 of the file
-        name = hashlib.md5(file.filename.encode()).hexdigest()
-        uploads_dir = 'uploads'
-        os.makedirs(uploads_dir, exist_ok=True)
-        os.makedirs('output_vocals', exist_ok=True)
-        audio_path = f'uploads/{name}'
-        # write the file to disk
-        with open(audio_path, 'wb') as f:
-            # Read the uploaded file and convert it to WAV if necessary
-            audio = AudioSegment.from_file(BytesIO(await file.read()))
-            audio.export(audio_path, format="wav")
-
-        log("analyze", "Extracting vocals...")
-        vocals = get_vocals(audio_path)
-
-        log("analyze", "Transcribing visemes...")
-        visemes = await transcribe_visemes(vocals[0])
-
-        log("analyze", "Transcribing text...")
-        transcript_times = await transcribe_file(vocals[0], transcript)
-
-        log("analyze", "Analyzing beats...")
-        beats = await analyze_beat(audio_path)
-
-        # delete all files in the vocals
-        #for vocal in vocals:
-        #    os.remove(vocal)
-
-        data = []
-        words = []
-        viseme_list = []
-
-        log("analyze", "Combining data...")
-        # append beats if we have them
-        for beat in beats:
-            data.append(beat)
-
-        for i in range(len(transcript_times)):
-            # if the transcript time has a caption, add it to the data
-            if "caption" in transcript_times[i]:
-                data.append({
-                    "data": transcript_times[i]["caption"],
-                    "time": convert_to_ms(transcript_times[i]["start"]),
-                    "type": "CAPTION"
-                })
-            else:
-                # trim space off the word
-                word = transcript_times[i]["word"].strip()
-                # if the word is in {emote:trigger-name} it is an action or emote trigger change the type to EMOTE
-                type = "WORD"
-                if word.startswith("[emote:") and word.endswith("]"):
-                    type = "EMOTE"
-                    # Replace the word with the values inside the curly braces
-                    word = word[7:-1]
-                elif word.startswith("[emotion:") and word.endswith("]"):
-                    type = "EMOTE"
-                    word = word[9:-1]
-                elif word.startswith("[action:") and word.endswith("]"):
-                    type = "ACTION"
-                    # Replace the word with the values inside the curly braces
-                    word = word[8:-1]
-
-                entry = {
-                    "data": word,
-                    "time": convert_to_ms(transcript_times[i]["start"]),
-                    "type": type
-                }
-                data.append(entry)
-                if type == "WORD":
-                    words.append(entry)
-
-        for i in range(len(visemes["transcription"])):
-            data.append({
-                "data": visemes["transcription"][i]["phoneme"],
-                "time": convert_to_ms(visemes["transcription"][i]["start_time"]),
-                "type": "PHONE"
-            })
-            start_time = convert_to_ms(visemes["transcription"][i]["start_time"])
-            end_time = convert_to_ms(visemes["transcription"][i]["end_time"])
-            viseme = {
-                "data": visemes["transcription"][i]["viseme"],
-                "time": start_time,
-                "length": end_time - start_time,
-                "type": "VISEME"
-            }
-            data.append(viseme)
-            viseme_list.append(viseme)
-
-        # iterate over data for VISEMEs if there is more than 500ms between visemes add a sil viseme
-        for i in range(len(viseme_list) - 1):
-            delta = viseme_list[i + 1]["time"] - (viseme_list[i]["time"] + viseme_list[i]["length"])
-            if delta > 100:
-                data.append({
-                    "data": "sil",
-                    "time": viseme_list[i]["time"] + viseme_list[i]["length"],
-                    "type": "VISEME"
-                })
-                data.append({
-                    "data": "sil",
-                    "time": viseme_list[i + 1]["time"] - 10,
-                    "type": "VISEME"
-                })
-
-        # add a sil after the last viseme
-        data.append({
-            "data": "sil",
-            "time": viseme_list[-1]["time"] + viseme_list[-1]["length"],
-            "type": "VISEME"
-        })
-
-        if len(words) > 2:
-            # iterate over the words, if there is more than 5 sec between them put a instrumental emote right after the last word
-            # of the break put a vocal emote right before the next word
-            for i in range(len(words) - 1):
-                delta = words[i + 1]["time"] - words[i]["time"]
-                if delta > 5000:
-                    data.append({
-                        "data": "instrumental",
-                        "time": words[i]["time"],
-                        "type": "EMOTE"
-                    })
-                    data.append({
-                        "data": "vocal",
-                        "time": max(0, words[i + 1]["time"] - 250),
-                        "type": "EMOTE"
-                    })
-            # if there is more than 5 sec before the first word put a instrumental emote at the beginning, otherwise put the vocal emote
-            if words[0]["time"] > 5000:
-                data.insert(0, {
-                    "data": "instrumental",
-                    "time": 0,
-                    "type": "EMOTE"
-                })
-                # insert a vocal at the time of the first word
-                data.insert(1, {
-                    "data": "vocal",
-                    "time": words[0]["time"],
-                    "type": "EMOTE"
-                })
-            else:
-                data.insert(0, {
-                    "data": "vocal",
-                    "time": words[0]["time"],
-                    "type": "EMOTE"
-                })
-
-            # add a instrumental emote at the last word
-            data.append({
-                "data": "instrumental",
-                "time": words[-1]["time"] + 250,
-                "type": "EMOTE"
-            })
-
-
-        # Iterate over the data and calculate the sample offset based on the time and the sample rate of 24000 single channel
-        for d in data:
-            d["offset"] = int(d["time"] * sample_rate / 1000 * channels)
-
-        log("analyze", "Sorting data...")
-        # sort the data by start time
-        data.sort(key=lambda x: x["offset"])
+        audio, audio_hash = await store_upload(file)
+        data, timings = await get_timeline(audio, audio_hash, transcript, sample_rate, channels, whisper_model=whisper_model, vocal_model=vocal_model, stages=stages)
+        headers = {"Server-Timing": format_server_timing(timings)} if timings else None
 
         # Check request type
         if request.headers.get("accept") == "application/json":
             # Return JSON response with data
             response_data = {"data": data}
             if include_base64:
-                data = encode_json_and_file(data, audio_path, output_format=output_format, sample_rate=sample_rate, channels=channels)
-                base64data = base64.b64encode(data).decode("utf-8")
-                response_data["data_encoded_audio"] = base64data
-            os.remove(audio_path)
-            return JSONResponse(content=response_data)
+                # stream the base64 payload as it is encoded instead of building it in memory
+                encoded = iter_encoded(data, audio, output_format=output_format, sample_rate=sample_rate, channels=channels, timeline_format=timeline_format)
+                return StreamingResponse(iter_json_with_payload(response_data, encoded), media_type="application/json", headers=headers)
+            return JSONResponse(content=response_data, headers=headers)
         else:
             # Return as a streaming response for binary data
-            encoded = encode_json_and_file(data, audio_path, output_format=output_format)
-            os.remove(audio_path)
-            media_type = "audio/wav" if output_format == "wav" else "audio/mpeg" if output_format == "mp3" else "application/octet-stream"
-            return StreamingResponse(BytesIO(encoded), media_type=media_type)
+            encoded = iter_encoded(data, audio, output_format=output_format, sample_rate=sample_rate, channels=channels, timeline_format=timeline_format)
+            return StreamingResponse(encoded, media_type=output_media_type(output_format), headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         traceback.print_exc()
         log("analyze", f"Error processing audio: {str(e)}")
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+
+# Clips one /analyze-batch/ call may hold, counting every clip inside an archive. Every decoded clip stays in
+# memory until the batch is done, so the uncompressed bytes and the audio seconds of all clips are capped as well
+MAX_BATCH_FILES = int(os.environ.get("LIPSYNC_BATCH_MAX_FILES", 256))
+MAX_BATCH_BYTES = int(os.environ.get("LIPSYNC_BATCH_MAX_MB", 512)) * 1024 * 1024
+MAX_BATCH_SECONDS = float(os.environ.get("LIPSYNC_BATCH_MAX_SECONDS", 30 * 60))
+
+
+def check_batch_size(count, size=0, seconds=0):
+    if count > MAX_BATCH_FILES:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {MAX_BATCH_FILES} clips")
+    if size > MAX_BATCH_BYTES:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {MAX_BATCH_BYTES // (1024 * 1024)}MB of clips")
+    if seconds > MAX_BATCH_SECONDS:
+        raise HTTPException(status_code=413, detail=f"A batch can hold at most {MAX_BATCH_SECONDS:.0f}s of audio")
+
+
+def archive_members(path, batch_clips=0, batch_bytes=0, batch_seconds=0):
+    """
+    Every file in the zip except folders and macOS metadata. The batch limits are checked, with the clips, bytes
+    and seconds of the batch so far, before anything is extracted: the uncompressed size of every member and the
+    duration WAV and FLAC headers declare.
+    """
+    with zipfile.ZipFile(path) as archive:
+        members = [m for m in archive.infolist() if not m.is_dir() and not m.filename.startswith("__MACOSX/")]
+        check_batch_size(batch_clips + len(members), batch_bytes + sum(member.file_size for member in members))
+        for member in members:
+            if member.file_size > MAX_UPLOAD_BYTES:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"{member.filename} is larger than the {MAX_UPLOAD_BYTES // (1024 * 1024)}MB limit"
+                )
+            with archive.open(member) as source:
+                batch_seconds += probe_header_duration(source.read(PROBE_BYTES)) or 0
+            check_batch_size(0, seconds=batch_seconds)
+    return members
+
+
+def extract_member(path, member):
+    # one clip of the zip, extracted next to the uploads
+    clip_path = os.path.join(UPLOADS_DIR, f"{uuid.uuid4().hex}{os.path.splitext(member.filename)[1]}")
+    try:
+        with zipfile.ZipFile(path) as archive, archive.open(member) as source, open(clip_path, "wb") as target:
+            shutil.copyfileobj(source, target)
+    except BaseException:
+        remove_file(clip_path)
+        raise
+    return clip_path
+
+
+def decode_clip(path, name):
+    audio, audio_hash = decode_upload(path)
+    # clips from an archive weren't probed while spooling
+    check_duration(audio.duration, MAX_UPLOAD_SECONDS, name)
+    return audio, audio_hash
+
+
+async def store_batch(files: List[UploadFile]):
+    """
+    Decode every clip of a batch upload, zip archives are opened up into the clips they hold. Returns a
+    {"file", "audio", "hash"} dict per clip, or {"file", "error"} for a clip that couldn't be read.
+    """
+    clips = []
+    size = seconds = 0
+    for file in files:
+        try:
+            upload = await spool_upload(file)
+        except HTTPException as e:
+            clips.append({"file": file.filename, "error": e.detail})
+            continue
+
+        with upload:
+            if zipfile.is_zipfile(upload.path):
+                members = await asyncio.to_thread(archive_members, upload.path, len(clips), size, seconds)
+                size += sum(member.file_size for member in members)
+            else:
+                members = [None]
+                size += upload.size
+                check_batch_size(len(clips) + 1, size)
+
+            # one clip at a time, so at most one member of an archive is ever extracted
+            for member in members:
+                name = file.filename if member is None else member.filename
+                path = upload.path
+                try:
+                    if member is not None:
+                        path = await asyncio.to_thread(extract_member, upload.path, member)
+                    audio, audio_hash = await asyncio.to_thread(decode_clip, path, name)
+                    clips.append({"file": name, "audio": audio, "hash": audio_hash})
+                except HTTPException as e:
+                    clips.append({"file": name, "error": e.detail})
+                except Exception as e:
+                    clips.append({"file": name, "error": f"Could not decode {name}: {e}"})
+                finally:
+                    if path != upload.path:
+                        remove_file(path)
+
+                # the decoded length counts for formats whose header doesn't declare it
+                if "audio" in clips[-1]:
+                    seconds += clips[-1]["audio"].duration
+                    check_batch_size(len(clips), size, seconds)
+    return clips
+
+
+async def analyze_batch(clips, sample_rate=24000, channels=1, whisper_model=None, vocal_model=None, stages=None):
+    """
+    Timelines for many decoded clips ({audio_hash: DecodedAudio}) at once. Separation packs the patches of
+    every clip into shared model batches and Whisper transcribes several clips per window, the other models run
+    clip by clip. Returns {audio_hash: timeline} and the stage timings.
+    """
+    stages = TIMELINE_STAGES if stages is None else stages
+    audios = list(clips.values())
+    # the same stage graph as analyze_audio, every stage handles the whole batch. Packed clips are short and
+    # mostly voiced, so Whisper gets them whole rather than cut to their voiced segments.
+    model_stages = {}
+    if "words" in stages:
+        model_stages["words"] = (("vocals",), lambda vocals: transcribe_files([stems.wave("vocals") for stems in vocals], whisper_model))
+    if "visemes" in stages:
+        model_stages["visemes"] = (
+            ("vocals", "activity"),
+            lambda vocals, activity: asyncio.gather(*(transcribe_visemes_wave(stems.wave("vocals"), voiced, stems.sample_rates["vocals"]) for stems, voiced in zip(vocals, activity)))
+        )
+    if model_stages or "emotes" in stages:
+        model_stages["vocals"] = ((), lambda: separate_vocals_batch(audios, vocal_model, n_fft=RESULT_CACHE_PARAMS["n_fft"], hop_length=RESULT_CACHE_PARAMS["hop_length"], activity=True, stems=("vocals",), asr=True, write=False))
+        model_stages["activity"] = (("vocals",), lambda vocals: asyncio.to_thread(lambda: [stems.activity() for stems in vocals]))
+    if "beats" in stages:
+        model_stages["beats"] = ((), lambda: asyncio.gather(*(analyze_beat(audio) for audio in audios)))
+
+    results, timings = await run_stages(model_stages)
+
+    log("analyze", "Combining data...")
+    timelines = {}
+    for i, (audio_hash, audio) in enumerate(clips.items()):
+        beats, words, visemes, activity = (
+            results[name][i] if name in results else None for name in ("beats", "words", "visemes", "activity")
+        )
+        with measure("timeline", audio.duration):
+            timelines[audio_hash] = build_timeline(beats, words, visemes, sample_rate, channels, stages, activity).to_dicts()
+
+    return timelines, timings
+
+
+@app.post("/analyze-batch/")
+async def process_audio_batch(
+        files: List[UploadFile] = File(...),  # Clips, or zip archives of clips
+        sample_rate: Optional[int] = Form(24000),  # Sample rate the event offsets are computed for
+        channels: Optional[int] = Form(1),  # Channel count the event offsets are computed for
+        whisper_model: Optional[str] = Form(None),  # Whisper model size, the server default when not set
+        vocal_model: Optional[str] = Form(None),  # Separation checkpoint name, the server default when not set
+        stages: Optional[str] = Form(None)  # Comma separated subset of visemes,words,beats,emotes, all when not set
+):
+    """
+    Analyze many short clips in one call. Returns the timeline of every clip in upload order, a clip that
+    can't be decoded gets an error instead without failing the others.
+    """
+    log("analyze", f"Received batch of {len(files)} files")
+    check_models(whisper_model, vocal_model)
+    stages = parse_stages(stages)
+    check_batch_size(len(files))
+    try:
+        clips = await store_batch(files)
+
+        # cached clips are answered from the cache, the rest are analyzed together
+        timelines = {}
+        pending = {}
+        cache_keys = {}
+        for clip in clips:
+            if "error" in clip or clip["hash"] in timelines or clip["hash"] in pending:
+                continue
+            cache_key = timeline_cache_key(clip["hash"], None, sample_rate, channels, whisper_model, vocal_model, stages, batch=True)
+            data = result_cache.get(cache_key)
+            if data is not None:
+                timelines[clip["hash"]] = data
+            else:
+                pending[clip["hash"]] = clip["audio"]
+                cache_keys[clip["hash"]] = cache_key
+
+        timings = {}
+        if pending:
+            log("analyze", f"Analyzing {len(pending)} of {len(clips)} clips as one batch")
+            analyzed, timings = await analyze_batch(pending, sample_rate, channels, whisper_model, vocal_model, stages)
+            for audio_hash, data in analyzed.items():
+                result_cache.put(cache_keys[audio_hash], data)
+                timelines[audio_hash] = data
+
+        results = [
+            {"file": clip["file"], "error": clip["error"]} if "error" in clip else {"file": clip["file"], "data": timelines[clip["hash"]]}
+            for clip in clips
+        ]
+        headers = {"Server-Timing": format_server_timing(timings)} if timings else None
+        return JSONResponse(content={"results": results, "timings": timings}, headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        traceback.print_exc()
+        log("analyze", f"Error processing batch: {str(e)}")
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+class StageStream(object):
+    # Progress listener that hands finished stage results to a streaming response as they arrive
+
+    def __init__(self):
+        self.queue = asyncio.Queue()
+
+    def stage_started(self, name):
+        pass
+
+    def stage_finished(self, name, duration, result=None):
+        self.queue.put_nowait((name, duration, result))
+
+
+def format_stream_message(kind, payload, sse):
+    if sse:
+        return f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+    return json.dumps({kind: payload}) + "\n"
+
+
+async def stream_timeline(audio, audio_hash, transcript, sample_rate, channels, sse, stages=None, whisper_model=None, vocal_model=None):
+    """
+    Yield timeline events as soon as the stage producing them finishes, then a summary with the full sorted
+    timeline. Events are NDJSON lines ({"event": {...}}) or server-sent events when `sse` is set.
+    """
+    stream = StageStream()
+    timeline = Timeline(sample_rate, channels)
+    analysis = asyncio.ensure_future(get_timeline(audio, audio_hash, transcript, sample_rate, channels, progress=stream, whisper_model=whisper_model, vocal_model=vocal_model, stages=stages))
+    sent_events = False
+    try:
+        while True:
+            finished_stage = asyncio.ensure_future(stream.queue.get())
+            await asyncio.wait({finished_stage, analysis}, return_when=asyncio.FIRST_COMPLETED)
+            if not finished_stage.done():
+                finished_stage.cancel()
+                if stream.queue.empty():
+                    break
+                finished_stage = stream.queue.get_nowait()
+            else:
+                finished_stage = finished_stage.result()
+
+            name, duration, result = finished_stage
+            yield format_stream_message("stage", {"name": name, "duration": duration}, sse)
+            for event in timeline.to_dicts(timeline.stage_events(name, result, stages)):
+                sent_events = True
+                yield format_stream_message("event", event, sse)
+
+        try:
+            data, timings = analysis.result()
+        except Exception as e:
+            traceback.print_exc()
+            log("analyze", f"Error processing audio: {str(e)}")
+            yield format_stream_message("error", str(e), sse)
+            return
+
+        # cached results never run a stage, so send their events now
+        if not sent_events:
+            for event in data:
+                yield format_stream_message("event", event, sse)
+
+        yield format_stream_message("summary", {"data": data, "timings": timings}, sse)
+    finally:
+        if not analysis.done():
+            analysis.cancel()
+
+
+@app.post("/analyze-stream/")
+async def process_audio_stream(
+        request: Request,
+        file: UploadFile = File(...),
+        transcript: Optional[str] = Form(None),  # Optional transcript input for forced alignment
+        sample_rate: Optional[int] = Form(24000),  # Sample rate the event offsets are computed for
+        channels: Optional[int] = Form(1),  # Channel count the event offsets are computed for
+        whisper_model: Optional[str] = Form(None),  # Whisper model size, the server default when not set
+        vocal_model: Optional[str] = Form(None),  # Separation checkpoint name, the server default when not set
+        stages: Optional[str] = Form(None)  # Comma separated subset of visemes,words,beats,emotes, all when not set
+):
+    """
+    Streaming variant of /analyze/. BEAT, PHONE/VISEME and WORD/CAPTION/EMOTE events are sent as soon as the
+    stage producing them finishes, followed by a summary with the full sorted timeline. Send
+    `Accept: text/event-stream` for server-sent events, otherwise the response is NDJSON.
+    """
+    log("analyze", f"Received file {file.filename} for streaming")
+    check_models(whisper_model, vocal_model)
+    stages = parse_stages(stages)
+    audio, audio_hash = await store_upload(file)
+    sse = "text/event-stream" in request.headers.get("accept", "")
+    return StreamingResponse(
+        stream_timeline(audio, audio_hash, transcript, sample_rate, channels, sse, stages, whisper_model, vocal_model),
+        media_type="text/event-stream" if sse else "application/x-ndjson"
+    )
+
+
+async def run_analysis_job(job, upload, transcript, sample_rate, channels):
+    # decoded on the worker, so a job waiting in the queue only holds its spooled upload on disk
+    with upload:
+        audio, audio_hash = await asyncio.to_thread(decode_upload, upload.path)
+    params = job.params
+    data, _ = await get_timeline(
+        audio, audio_hash, transcript, sample_rate, channels, progress=job, whisper_model=params["whisper_model"],
+        vocal_model=params["vocal_model"], stages=params["stages"]
+    )
+
+    # encode the payload now so the job doesn't have to keep the decoded audio around until it is fetched
+    await asyncio.to_thread(
+        write_payload, params["payload_path"], data, audio, output_format=params["output_format"],
+        sample_rate=sample_rate, channels=channels, timeline_format=params["timeline_format"]
+    )
+
+    return data
+
+
+def write_payload(path, json_data, audio, **kwargs):
+    with open(path, "wb") as f:
+        for chunk in iter_encoded(json_data, audio, **kwargs):
+            f.write(chunk)
+
+
+def remove_file(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+@app.post("/jobs/", status_code=202)
+async def submit_job(
+        file: UploadFile = File(...),
+        transcript: Optional[str] = Form(None),  # Optional transcript input for forced alignment
+        output_format: Optional[str] = Form("pcm"),  # Specify output format: pcm, wav, mp3
+        include_base64: Optional[bool] = Form(False),  # Include base64 encoded audio in the result
+        sample_rate: Optional[int] = Form(24000),  # Specify the sample rate for the audio
+        channels: Optional[int] = Form(1),  # Specify the number of channels for the audio
+        timeline_format: Optional[str] = Form("json"),  # Timeline encoding in the binary payload: json, binary
+        whisper_model: Optional[str] = Form(None),  # Whisper model size, the server default when not set
+        vocal_model: Optional[str] = Form(None),  # Separation checkpoint name, the server default when not set
+        stages: Optional[str] = Form(None)  # Comma separated subset of visemes,words,beats,emotes, all when not set
+):
+    """
+    Queue an upload for analysis and return its job id right away. Poll /jobs/{job_id} for progress, then fetch
+    /jobs/{job_id}/result or /jobs/{job_id}/audio once it is done.
+    """
+    log("jobs", f"Received file {file.filename}")
+    check_models(whisper_model, vocal_model)
+    stages = parse_stages(stages)
+    upload = await spool_upload(file)
+    os.makedirs(JOB_PAYLOAD_DIR, exist_ok=True)
+    payload_path = os.path.join(JOB_PAYLOAD_DIR, f"{uuid.uuid4().hex}.bin")
+
+    def cleanup():
+        # the upload is already gone once the job ran, unless the job never got to start
+        upload.remove()
+        remove_file(payload_path)
+
+    try:
+        job = job_queue.submit(
+            run_analysis_job, upload, transcript, sample_rate, channels,
+            params={
+                "payload_path": payload_path,
+                "output_format": output_format,
+                "include_base64": include_base64,
+                "timeline_format": timeline_format,
+                "whisper_model": whisper_model,
+                "vocal_model": vocal_model,
+                "stages": stages,
+            },
+            on_expire=cleanup
+        )
+    except QueueFullError as e:
+        upload.remove()
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+    return job.to_dict()
+
+
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
+
+
+def get_finished_job(job_id):
+    job = get_job(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return get_job(job_id).to_dict()
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = get_finished_job(job_id)
+    params = job.params
+    response_data = {"data": job.result}
+    if params["include_base64"]:
+        return StreamingResponse(
+            iter_json_with_payload(response_data, iter_payload(params["payload_path"])), media_type="application/json"
+        )
+    return JSONResponse(content=response_data)
+
+
+def iter_payload(path, chunk_size=1024 * 1024):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+@app.get("/jobs/{job_id}/audio")
+async def job_audio(job_id: str):
+    job = get_finished_job(job_id)
+    params = job.params
+
+    return StreamingResponse(iter_payload(params["payload_path"]), media_type=output_media_type(params["output_format"]))
+
 if __name__ == "__main__":
-    #if args --init is passed, don't start the server
-    if "--init" not in sys.argv:
-        uvicorn.run(app, host="0.0.0.0", port=8000)
+    p = argparse.ArgumentParser()
+    p.add_argument('--init', '-i', action='store_true', help="load (and download) every model, then exit")
+    p.add_argument('--pretrained_model', '-P', type=str, default=vocal_remover.api.SEPARATION_MODEL_PATH)
+    p.add_argument('--complex', '-X', action='store_true', help="for checkpoints that don't tell whether they are complex")
+    p.add_argument('--no-warmup', action='store_true', help="load models on first use instead of at startup")
+    args, _ = p.parse_known_args()
+    vocal_remover.api.SEPARATION_MODEL_PATH = args.pretrained_model
+    vocal_remover.api.SEPARATION_COMPLEX = args.complex
+
+    #if args --init is passed, load the models and don't start the server
+    if args.init:
+        registry.warmup()
+        sys.exit(0 if registry.ready else 1)
+
+    if not args.no_warmup:
+        app.on_event("startup")(start_warmup)
+    uvicorn.run(app, host="0.0.0.0", port=8000)
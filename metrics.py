@@ -0,0 +1,166 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import soundfile as sf
+from fastapi.responses import PlainTextResponse
+
+from app import app
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300, 600)
+AUDIO_SECONDS_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+REAL_TIME_FACTOR_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+
+
+class Histogram(object):
+    """Cumulative histogram per label set, rendered in the Prometheus text format."""
+
+    def __init__(self, name, help, buckets, label_names=("stage",)):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # one count per bucket plus +Inf, then the sum
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        for key, (counts, total) in series:
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, key))
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {counts[-1]}")
+        return "\n".join(lines)
+
+
+class Counter(object):
+    """Running total per label set, rendered in the Prometheus text format."""
+
+    def __init__(self, name, help, label_names=("stage",)):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, key))
+            lines.append(f"{self.name}{{{labels}}} {value}")
+        return "\n".join(lines)
+
+
+stage_wall_seconds = Histogram(
+    "lipsync_stage_wall_seconds", "Wall clock time spent in a processing stage.", SECONDS_BUCKETS
+)
+stage_cpu_seconds = Histogram(
+    "lipsync_stage_cpu_seconds", "CPU time of the thread running a processing stage.", SECONDS_BUCKETS
+)
+stage_audio_seconds = Histogram(
+    "lipsync_stage_audio_seconds", "Seconds of audio handled by a processing stage.", AUDIO_SECONDS_BUCKETS
+)
+stage_real_time_factor = Histogram(
+    "lipsync_stage_real_time_factor", "Wall time of a processing stage divided by the audio duration.",
+    REAL_TIME_FACTOR_BUCKETS
+)
+separation_patches = Counter(
+    "lipsync_separation_patches_total", "Spectrogram patches seen by the separator, by whether the model ran on them.",
+    label_names=("result",)
+)
+METRICS = [stage_wall_seconds, stage_cpu_seconds, stage_audio_seconds, stage_real_time_factor, separation_patches]
+
+
+def record_stage(stage, wall, cpu, audio_seconds=None):
+    stage_wall_seconds.observe(wall, stage=stage)
+    stage_cpu_seconds.observe(cpu, stage=stage)
+    if audio_seconds:
+        stage_audio_seconds.observe(audio_seconds, stage=stage)
+        stage_real_time_factor.observe(wall / audio_seconds, stage=stage)
+
+
+def record_patches(patches, skipped):
+    # silent patches get a constant mask instead of a forward pass
+    separation_patches.inc(patches - skipped, result="predicted")
+    separation_patches.inc(skipped, result="skipped")
+
+
+def audio_duration(audio):
+    """Duration in seconds of decoded audio or an audio file, None when it can't be told cheaply."""
+    duration = getattr(audio, "duration", None)
+    if duration is not None:
+        return duration
+    try:
+        return sf.info(audio).duration
+    except Exception:
+        return None
+
+
+@contextmanager
+def measure(stage, audio_seconds=None):
+    """
+    Record the wall and thread CPU time of the block under `stage`. The audio duration can be passed up front
+    or set on the yielded dict once it is known. CPU time is the calling thread's, so work a library hands to
+    its own threads isn't included.
+    """
+    sample = {"audio_seconds": audio_seconds}
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield sample
+    finally:
+        record_stage(stage, time.perf_counter() - wall, time.thread_time() - cpu, sample["audio_seconds"])
+
+
+def measure_iter(stage, iterable, audio_seconds=None):
+    # like measure(), for a generator: only the time spent producing items counts, not the time the consumer
+    # takes between them (sending a streamed response for example)
+    wall = cpu = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                wall += time.perf_counter() - wall_start
+                cpu += time.thread_time() - cpu_start
+            yield item
+    finally:
+        record_stage(stage, wall, cpu, audio_seconds)
+
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,201 @@
+import asyncio
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from fastapi.responses import JSONResponse
+
+from app import app, log
+
+# Memory the loaded models may take together, 0 for no limit. Past it the least recently used models are dropped.
+MODEL_MEMORY_BUDGET = int(os.environ.get("LIPSYNC_MODEL_MEMORY_MB", 0)) * 1024 * 1024
+
+
+def model_size(model):
+    """Bytes of the parameters and buffers of a torch model, or of the torch models a wrapper object holds."""
+    if isinstance(model, torch.nn.Module):
+        modules = [model]
+    else:
+        modules = [value for value in getattr(model, "__dict__", {}).values() if isinstance(value, torch.nn.Module)]
+    size = 0
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class ModelRegistry(object):
+    """
+    Loads every model once, the first time it is asked for or during warmup(), and hands the same instance to
+    every module. Modules register a loader per model family at import, which is cheap, instead of loading the
+    model itself. A family can have several variants (Whisper sizes, separation checkpoints), each loaded on its
+    own and dropped least recently used first once the loaded models go over the memory budget. The default
+    variants are never dropped, so the service stays ready whatever other variants requests ask for.
+    """
+
+    def __init__(self, memory_budget=0):
+        self.memory_budget = memory_budget
+        self._loaders = {}
+        self._defaults = {}
+        self._variants = {}
+        self._models = OrderedDict()
+        self._sizes = {}
+        self._errors = {}
+        self._load_locks = {}
+        self._inference_locks = {}
+        self._lock = threading.Lock()
+        # loading happens here rather than on the inference pools, so a request that needs another model
+        # doesn't hold up the requests queued for the ones already loaded
+        self._load_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="model-load")
+
+    def register(self, family, loader, default=None, variants=None):
+        """
+        `loader(variant)` loads one variant of the family, families without variants get `loader()`. `default` is
+        the variant used when none is asked for, `variants` the list of allowed ones, either can be a callable so
+        they can change after import.
+        """
+        with self._lock:
+            self._loaders[family] = loader
+            self._defaults[family] = default
+            self._variants[family] = variants
+
+    def default_variant(self, family):
+        default = self._defaults[family]
+        return default() if callable(default) else default
+
+    def variants(self, family):
+        variants = self._variants[family]
+        return variants() if callable(variants) else variants
+
+    def resolve(self, family, variant=None):
+        # the default when no variant is asked for, ValueError for one that isn't allowed
+        if not variant:
+            return self.default_variant(family)
+        variants = self.variants(family)
+        if variants is not None and variant not in variants:
+            raise ValueError(f"Unknown {family} model {variant}, available: {', '.join(variants)}")
+        return variant
+
+    def get(self, family, variant=None):
+        key = (family, self.resolve(family, variant))
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # one lock per model, so loading Whisper doesn't hold up a request that only needs BeatNet
+        with load_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key]
+
+            name = self.key_name(key)
+            log("models", f"Loading {name}...")
+            start = time.time()
+            try:
+                loader = self._loaders[family]
+                model = loader(key[1]) if key[1] is not None else loader()
+            except Exception as e:
+                self._errors[key] = str(e)
+                raise
+            size = model_size(model)
+
+            with self._lock:
+                self._models[key] = model
+                self._sizes[key] = size
+                self._errors.pop(key, None)
+                self._evict(keep=key)
+            log("models", f"Loaded {name} ({size / (1024 * 1024):.0f}MB) in {time.time() - start:.2f}s")
+        return model
+
+    async def get_async(self, family, variant=None):
+        """get() without blocking the event loop or an inference pool while a model loads."""
+        key = (family, self.resolve(family, variant))
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._load_executor, self.get, family, variant)
+
+    def inference_lock(self, family, variant=None):
+        # for models that can only run one call at a time, shared by every user of the same variant
+        key = (family, self.resolve(family, variant))
+        with self._lock:
+            return self._inference_locks.setdefault(key, threading.Lock())
+
+    def _evict(self, keep):
+        # requests already running keep their reference, so their model stays usable until they finish
+        while self.memory_budget and sum(self._sizes.values()) > self.memory_budget:
+            # models whose size can't be measured free nothing that is counted, the defaults stay for readiness
+            victim = next(
+                (key for key in self._models if key != keep and self._sizes[key] and not self.is_default(key)), None
+            )
+            if victim is None:
+                break
+            del self._models[victim]
+            size = self._sizes.pop(victim)
+            log("models", f"Evicted {self.key_name(victim)} ({size / (1024 * 1024):.0f}MB) to stay in the memory budget")
+
+    def is_default(self, key):
+        return key[1] == self.default_variant(key[0])
+
+    @staticmethod
+    def key_name(key):
+        return f"{key[0]}:{key[1]}" if key[1] is not None else key[0]
+
+    def is_loaded(self, family, variant=None):
+        return (family, self.resolve(family, variant)) in self._models
+
+    def warmup(self, families=None):
+        """Load the default variant of the named families, all by default. Failures are reported by status()."""
+        for family in families or list(self._loaders):
+            try:
+                self.get(family)
+            except Exception:
+                traceback.print_exc()
+
+    def status(self):
+        status = {}
+        with self._lock:
+            loaded = list(self._models)
+        for family in self._loaders:
+            key = (family, self.default_variant(family))
+            if key not in loaded:
+                status[self.key_name(key)] = f"failed: {self._errors[key]}" if key in self._errors else "not loaded"
+        for key in loaded:
+            status[self.key_name(key)] = "loaded"
+        return status
+
+    @property
+    def ready(self):
+        # the default variant of every family is loaded
+        return all(self.is_loaded(family) for family in self._loaders)
+
+
+registry = ModelRegistry(MODEL_MEMORY_BUDGET)
+
+
+def start_warmup():
+    # load everything in the background so the server answers /healthz while the models load
+    threading.Thread(target=registry.warmup, name="model-warmup", daemon=True).start()
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    # 503 until the default model of every family is loaded
+    return JSONResponse(
+        content={"ready": registry.ready, "models": registry.status()},
+        status_code=200 if registry.ready else 503
+    )
@@ -0,0 +1,123 @@
+import base64
+import itertools
+import json
+import struct
+
+import numpy as np
+from pydub import AudioSegment
+
+from decoded_audio import DecodedAudio
+from metrics import measure_iter
+from timeline import Timeline, encode_binary
+
+# Frames per audio chunk of a streamed response, so a response never holds more than this much encoded PCM
+ENCODE_CHUNK_FRAMES = 64 * 1024
+
+
+def encode_timeline(json_data, sample_rate=24000, channels=1, timeline_format="json"):
+    """The timeline section of the payload and whether it uses the binary encoding."""
+    if timeline_format == "binary" and json_data:
+        # Compact string table + fixed width records instead of JSON, see timeline.encode_binary
+        timeline = json_data if isinstance(json_data, Timeline) else Timeline.from_dicts(json_data, sample_rate, channels)
+        return encode_binary(timeline), 1
+    # Convert JSON data to a byte array
+    return (json.dumps(json_data).encode('utf-8') if json_data else b''), 0
+
+
+def wav_header(data_length, sample_rate, channels):
+    # the 44 byte header pydub/wave write for 16-bit PCM
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_length, b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16,
+        b'data', data_length
+    )
+
+
+def iter_pcm16(view, chunk_frames=None):
+    # convert the float view to interleaved 16-bit PCM a chunk at a time, same as DecodedAudio.to_pcm16
+    chunk_frames = chunk_frames or ENCODE_CHUNK_FRAMES
+    frames = view.shape[-1]
+    for start in range(0, frames, chunk_frames):
+        chunk = view[..., start:start + chunk_frames]
+        if chunk.ndim > 1:
+            chunk = chunk.T
+        yield (np.clip(chunk, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+
+def iter_encoded(json_data, audio, output_format="pcm", sample_rate=24000, channels=1, timeline_format="json"):
+    chunks = encode_chunks(json_data, audio, output_format, sample_rate, channels, timeline_format)
+    return measure_iter("encode", chunks, getattr(audio, "duration", None))
+
+
+def encode_chunks(json_data, audio, output_format="pcm", sample_rate=24000, channels=1, timeline_format="json"):
+    """
+    Yield the payload encode_json_and_file builds in pieces: the header, computed up front from the known
+    lengths, then the timeline, then the audio converted chunk by chunk from the resampled view. Only mp3,
+    whose length isn't known until it is encoded, is produced in one piece.
+    """
+    LONG_SIZE = 8
+
+    json_bytes, has_binary_timeline = encode_timeline(json_data, sample_rate, channels, timeline_format)
+    json_length = len(json_bytes)
+
+    if not isinstance(audio, DecodedAudio):
+        audio = DecodedAudio.from_file(audio)
+    view = audio.view(sample_rate, channels)
+
+    if output_format == "mp3":
+        segment = AudioSegment(
+            data=audio.to_pcm16(sample_rate, channels), sample_width=2, frame_rate=sample_rate, channels=channels
+        )
+        audio_chunks = [segment.export(format="mp3").read()]
+        binary_length = len(audio_chunks[0])
+    else:
+        # 16-bit PCM, for wav behind a RIFF header
+        pcm_length = view.shape[-1] * channels * 2
+        audio_chunks = iter_pcm16(view)
+        if output_format == "wav":
+            audio_chunks = itertools.chain([wav_header(pcm_length, sample_rate, channels)], audio_chunks)
+            pcm_length += 44
+        binary_length = pcm_length
+
+    # Set flags
+    has_binary = 1 if binary_length > 0 else 0
+    has_json = 1 if json_length > 0 and not has_binary_timeline else 0
+
+    # Create the flag byte, a binary timeline takes the place of the JSON and sets its own bit
+    flags = (has_binary | (has_json << 1) | (has_binary_timeline << 2))
+
+    # Construct the header
+    yield struct.pack(
+        f'B{LONG_SIZE}s{LONG_SIZE}s',
+        flags,
+        struct.pack('q', json_length),  # 'q' is for 8-byte signed long
+        struct.pack('q', binary_length)  # 'q' for 8-byte signed long
+    )
+    if json_bytes:
+        yield json_bytes
+    yield from audio_chunks
+
+
+def encode_json_and_file(json_data, audio_path, output_format="pcm", sample_rate=24000, channels=1, timeline_format="json"):
+    return b"".join(iter_encoded(json_data, audio_path, output_format, sample_rate, channels, timeline_format))
+
+
+def iter_base64(chunks):
+    # base64 of a chunked payload, carrying bytes over so every piece but the last encodes a multiple of 3
+    remainder = b""
+    for chunk in chunks:
+        chunk = remainder + chunk
+        cut = len(chunk) - len(chunk) % 3
+        remainder = chunk[cut:]
+        if cut:
+            yield base64.b64encode(chunk[:cut])
+    if remainder:
+        yield base64.b64encode(remainder)
+
+
+def iter_json_with_payload(response_data, chunks):
+    # {"data": ..., "data_encoded_audio": "<base64>"} without building the base64 string in memory
+    yield json.dumps(response_data)[:-1].encode("utf-8") + b', "data_encoded_audio": "'
+    yield from iter_base64(chunks)
+    yield b'"}'
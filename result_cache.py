@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def hash_audio(audio_bytes, *parts):
+    # hash the decoded audio samples together with anything describing their layout (rate, channels, width)
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\0')
+    h.update(audio_bytes)
+    return h.hexdigest()
+
+
+class ResultCache(object):
+    """Two tier (memory LRU + size bounded disk with TTL) store for analysis results."""
+
+    def __init__(self, cache_dir='cache', max_memory_items=64, max_disk_bytes=512 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(audio_hash, **params):
+        # every parameter that changes the output has to be part of the key
+        encoded = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(f'{audio_hash}:{encoded}'.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # touch the file so disk eviction treats it as recently used
+        os.utime(path, None)
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        self._remember(key, value)
+
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+        self._evict_disk()
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        now = time.time()
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            # expired entries go first regardless of the size budget
+            if now - stat.st_mtime > self.ttl:
+                self._remove(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        # drop the least recently used files until we are within budget
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
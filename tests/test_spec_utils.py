@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from vocal_remover.lib import spec_utils
+
+N_FFT = 2048
+HOP_LENGTH = 1024
+SR = 44100
+
+
+def stereo_wave(seconds=3, seed=0):
+    # a chord plus noise, different in each channel, so both channels and every bin carry signal
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SR)) / SR
+    tones = sum(np.sin(2 * np.pi * f * t) for f in (220, 277, 330, 3520))
+    wave = np.stack([tones, np.roll(tones, 441)]) * 0.1 + 0.05 * rng.standard_normal((2, len(t)))
+    return wave.astype(np.float32)
+
+
+def assert_close(actual, expected):
+    # relative to the largest value, the backends agree to float32 precision
+    assert np.allclose(actual, expected, rtol=0, atol=1e-5 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize('backend', spec_utils.STFT_BACKENDS)
+def test_wave_to_spectrogram(backend):
+    wave = stereo_wave()
+    expected = spec_utils.wave_to_spectrogram(wave, HOP_LENGTH, N_FFT)
+    spec = spec_utils.wave_to_spectrogram(wave, HOP_LENGTH, N_FFT, backend)
+
+    assert spec.shape == (2, N_FFT // 2 + 1, 1 + wave.shape[1] // HOP_LENGTH)
+    assert spec.dtype == np.complex64
+    assert_close(spec, expected)
+
+
+@pytest.mark.parametrize('backend', spec_utils.STFT_BACKENDS)
+def test_spectrogram_to_wave(backend):
+    wave = stereo_wave()
+    spec = spec_utils.wave_to_spectrogram(wave, HOP_LENGTH, N_FFT)
+    expected = spec_utils.spectrogram_to_wave(spec, HOP_LENGTH)
+    restored = spec_utils.spectrogram_to_wave(spec, HOP_LENGTH, backend)
+
+    assert restored.shape == expected.shape == (2, (spec.shape[2] - 1) * HOP_LENGTH)
+    assert restored.dtype == np.float32
+    assert_close(restored, expected)
+    assert_close(restored, wave[:, :restored.shape[1]])
+
+
+@pytest.mark.parametrize('backend', spec_utils.STFT_BACKENDS)
+def test_spectrogram_to_wave_single_frame(backend):
+    # librosa returns no samples for a lone frame, torch must not fail on it
+    spec = np.zeros((2, N_FFT // 2 + 1, 1), dtype=np.complex64)
+    assert spec_utils.spectrogram_to_wave(spec, HOP_LENGTH, backend).shape == (2, 0)
+
+
+@pytest.mark.parametrize('backend', spec_utils.STFT_BACKENDS)
+def test_spectrogram_frames(backend):
+    wave = stereo_wave()
+    n_frame = 1 + wave.shape[1] // HOP_LENGTH
+    expected = spec_utils.wave_to_spectrogram(wave, HOP_LENGTH, N_FFT)
+
+    def read(first, last):
+        # the samples first to last with zeros outside the wave, as api.wave_reader returns them
+        samples = np.zeros((2, last - first), dtype=np.float32)
+        start, end = max(first, 0), min(last, wave.shape[1])
+        samples[:, start - first:end - first] = wave[:, start:end]
+        return samples
+
+    # blocks reaching past both ends of the spectrogram
+    for start, end in ((-8, 40), (40, 100), (100, n_frame + 8)):
+        frames = spec_utils.spectrogram_frames(read, n_frame, start, end, HOP_LENGTH, N_FFT, backend)
+        assert frames.shape == (2, N_FFT // 2 + 1, end - start)
+        assert frames.dtype == np.complex64
+        first, last = max(start, 0), min(end, n_frame)
+        assert_close(frames[:, :, first - start:last - start], expected[:, :, first:last])
+        assert not frames[:, :, :first - start].any()
+        assert not frames[:, :, last - start:].any()
+
+
+@pytest.mark.parametrize('backend', spec_utils.STFT_BACKENDS)
+def test_overlap_add(backend):
+    # the wave of a spectrogram added block by block matches the inverse of the whole spectrogram
+    wave = stereo_wave()
+    spec = spec_utils.wave_to_spectrogram(wave, HOP_LENGTH, N_FFT, backend)
+    expected = spec_utils.spectrogram_to_wave(spec, HOP_LENGTH, backend)
+
+    overlap_add = spec_utils.OverlapAdd(spec.shape[2], HOP_LENGTH, N_FFT)
+    blocks = [overlap_add.add(spec[:, :, start:start + 17]) for start in range(0, spec.shape[2], 17)]
+    restored = np.concatenate(blocks + [overlap_add.finish()], axis=1)
+
+    assert restored.shape == expected.shape
+    assert_close(restored, expected)
@@ -0,0 +1,356 @@
+import numpy as np
+
+# Event type codes, also used by the binary timeline encoding so only ever append to this list
+EVENT_TYPES = ["BEAT", "WORD", "CAPTION", "EMOTE", "ACTION", "PHONE", "VISEME"]
+TYPE_CODES = {name: code for code, name in enumerate(EVENT_TYPES)}
+
+# What a request can ask for: PHONE/VISEME events, WORD/CAPTION/ACTION events and the EMOTE triggers written in
+# the transcript, BEAT events, and the instrumental/vocal EMOTE events at the edges of the vocal activity
+TIMELINE_STAGES = ("visemes", "words", "beats", "emotes")
+
+# Breaks in the vocals shorter than this don't get instrumental/vocal emotes
+EMOTE_GAP_MS = 5000
+
+# Events without a length (everything but the phoneme visemes) store NO_LENGTH
+NO_LENGTH = -1
+
+EVENT_DTYPE = np.dtype([
+    ("offset", "<i8"),  # sample offset in the encoded audio
+    ("time", "<i8"),  # ms
+    ("length", "<i8"),  # ms or NO_LENGTH
+    ("type", "u1"),  # index into EVENT_TYPES
+    ("data", "<u4"),  # index into the string table
+])
+
+
+def seconds_to_ms(seconds):
+    # whole milliseconds, truncated like int(seconds * 1000), of floats or the stringified floats transcribe_file returns
+    return (np.asarray(seconds, dtype=np.float64) * 1000).astype(np.int64)
+
+
+def is_sorted(events):
+    return len(events) < 2 or bool(np.all(events["offset"][1:] >= events["offset"][:-1]))
+
+
+def sort_events(events):
+    if is_sorted(events):
+        return events
+    return events[np.argsort(events["offset"], kind="stable")]
+
+
+def merge_two(a, b):
+    # merge two offset sorted arrays, on ties the events of `a` go first just like a stable sort of a + b
+    merged = np.empty(len(a) + len(b), dtype=EVENT_DTYPE)
+    a_positions = np.searchsorted(b["offset"], a["offset"], side="left") + np.arange(len(a))
+    b_positions = np.searchsorted(a["offset"], b["offset"], side="right") + np.arange(len(b))
+    merged[a_positions] = a
+    merged[b_positions] = b
+    return merged
+
+
+def merge_sorted(parts):
+    """
+    k-way merge of offset sorted event arrays. The result matches a stable sort of the concatenated parts,
+    without sorting anything.
+    """
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return np.empty(0, dtype=EVENT_DTYPE)
+
+    # merge neighbours pairwise so every event takes part in log(k) merges
+    while len(parts) > 1:
+        merged = [merge_two(parts[i], parts[i + 1]) for i in range(0, len(parts) - 1, 2)]
+        if len(parts) % 2:
+            merged.append(parts[-1])
+        parts = merged
+
+    return parts[0]
+
+
+class StringTable(object):
+
+    def __init__(self):
+        self.values = []
+        self._ids = {}
+
+    def intern(self, value):
+        # key on the type as well so 1, 1.0 and "1" stay distinct entries
+        key = (type(value), value)
+        index = self._ids.get(key)
+        if index is None:
+            index = len(self.values)
+            self.values.append(value)
+            self._ids[key] = index
+        return index
+
+    def intern_many(self, values):
+        return np.fromiter((self.intern(value) for value in values), dtype=np.uint32, count=len(values))
+
+
+class Timeline(object):
+    """
+    Timeline events kept as an EVENT_DTYPE structured array plus a string table for the event data. Events are
+    only turned into dicts when serialized with to_dicts().
+    """
+
+    def __init__(self, sample_rate=24000, channels=1):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.strings = StringTable()
+        self.events = np.empty(0, dtype=EVENT_DTYPE)
+
+    def make_events(self, times, type_name, data, lengths=None):
+        times = np.asarray(times, dtype=np.int64)
+        events = np.empty(len(times), dtype=EVENT_DTYPE)
+        events["time"] = times
+        events["length"] = NO_LENGTH if lengths is None else lengths
+        events["type"] = TYPE_CODES[type_name] if isinstance(type_name, str) else type_name
+        events["data"] = self.strings.intern(data) if isinstance(data, str) else self.strings.intern_many(data)
+        # sample offset based on the time, sample rate and channel count of the encoded audio
+        events["offset"] = (times * self.sample_rate / 1000 * self.channels).astype(np.int64)
+        return events
+
+    def beat_events(self, beats):
+        times = np.fromiter((beat["time"] for beat in beats), dtype=np.int64, count=len(beats))
+        data = [float(beat["data"]) for beat in beats]
+        return sort_events(self.make_events(times, "BEAT", data))
+
+    def word_events(self, transcript_times):
+        """Events for the Whisper words and captions. Returns the events and the times of the plain words."""
+        starts = seconds_to_ms([entry["start"] for entry in transcript_times])
+        types = np.empty(len(transcript_times), dtype=np.uint8)
+        data = []
+        for i, entry in enumerate(transcript_times):
+            # if the transcript time has a caption, add it to the data
+            if "caption" in entry:
+                types[i] = TYPE_CODES["CAPTION"]
+                data.append(entry["caption"])
+                continue
+
+            # trim space off the word
+            word = entry["word"].strip()
+            # if the word is in [emote:trigger-name] it is an action or emote trigger change the type to EMOTE
+            type = "WORD"
+            if word.startswith("[emote:") and word.endswith("]"):
+                type = "EMOTE"
+                word = word[7:-1]
+            elif word.startswith("[emotion:") and word.endswith("]"):
+                type = "EMOTE"
+                word = word[9:-1]
+            elif word.startswith("[action:") and word.endswith("]"):
+                type = "ACTION"
+                word = word[8:-1]
+            types[i] = TYPE_CODES[type]
+            data.append(word)
+
+        events = self.make_events(starts, types, data)
+        word_times = starts[types == TYPE_CODES["WORD"]]
+        return sort_events(events), word_times
+
+    def viseme_events(self, visemes):
+        """PHONE and VISEME events for the Allosaurus phonemes, including the sil visemes in the gaps."""
+        phonemes = visemes["transcription"]
+        starts = seconds_to_ms([phoneme["start_time"] for phoneme in phonemes])
+        lengths = seconds_to_ms([phoneme["end_time"] for phoneme in phonemes]) - starts
+
+        # one PHONE then one VISEME event per phoneme
+        phones = self.make_events(starts, "PHONE", [phoneme["phoneme"] for phoneme in phonemes])
+        shapes = self.make_events(starts, "VISEME", [phoneme["viseme"] for phoneme in phonemes], lengths)
+        pairs = np.empty(2 * len(phonemes), dtype=EVENT_DTYPE)
+        pairs[0::2] = phones
+        pairs[1::2] = shapes
+
+        # if there is more than 100ms between visemes close the first with a sil and open the next with one
+        ends = starts + lengths
+        gaps = np.flatnonzero(starts[1:] - ends[:-1] > 100)
+        sil_times = np.empty(2 * len(gaps), dtype=np.int64)
+        sil_times[0::2] = ends[gaps]
+        sil_times[1::2] = starts[gaps + 1] - 10
+
+        # add a sil after the last viseme
+        if len(phonemes):
+            sil_times = np.append(sil_times, ends[-1])
+
+        sils = self.make_events(sil_times, "VISEME", "sil")
+        return sort_events(np.concatenate([pairs, sils]))
+
+    def emote_events(self, word_times):
+        """
+        instrumental/vocal EMOTE events guessed from the gaps between words. Returns the events that go before
+        everything else in the timeline and the ones that go after.
+        """
+        empty = np.empty(0, dtype=EVENT_DTYPE)
+        if len(word_times) <= 2:
+            return empty, empty
+
+        # if there is more than 5 sec between words put an instrumental emote at the last word of the break
+        # and a vocal emote right before the next word
+        gaps = np.flatnonzero(np.diff(word_times) > 5000)
+        times = np.empty(2 * len(gaps), dtype=np.int64)
+        times[0::2] = word_times[gaps]
+        times[1::2] = np.maximum(0, word_times[gaps + 1] - 250)
+        data = ["instrumental", "vocal"] * len(gaps)
+
+        # add an instrumental emote after the last word
+        times = np.append(times, word_times[-1] + 250)
+        data.append("instrumental")
+        tail = sort_events(self.make_events(times, "EMOTE", data))
+
+        # if there is more than 5 sec before the first word start with an instrumental emote
+        if word_times[0] > 5000:
+            head = self.make_events([0, word_times[0]], "EMOTE", ["instrumental", "vocal"])
+        else:
+            head = self.make_events([word_times[0]], "EMOTE", ["vocal"])
+
+        return head, tail
+
+    def activity_emote_events(self, segments):
+        """
+        instrumental/vocal EMOTE events at the start and end of the voiced segments (see vocal_activity), for
+        breaks of at least EMOTE_GAP_MS. Returns the events that go before everything else and the ones after.
+        """
+        bounds = []
+        for start, end in seconds_to_ms(segments).reshape(-1, 2).tolist():
+            if bounds and start - bounds[-1][1] < EMOTE_GAP_MS:
+                bounds[-1][1] = end
+            else:
+                bounds.append([start, end])
+
+        if not bounds:
+            # no vocals at all
+            return self.make_events([0], "EMOTE", ["instrumental"]), np.empty(0, dtype=EVENT_DTYPE)
+
+        # instrumental at the end of every segment, vocal at the start of the next one
+        times = np.array(bounds, dtype=np.int64).ravel()[1:]
+        data = ["instrumental", "vocal"] * (len(bounds) - 1) + ["instrumental"]
+        tail = sort_events(self.make_events(times, "EMOTE", data))
+
+        if bounds[0][0] > EMOTE_GAP_MS:
+            head = self.make_events([0, bounds[0][0]], "EMOTE", ["instrumental", "vocal"])
+        else:
+            head = self.make_events([bounds[0][0]], "EMOTE", ["vocal"])
+
+        return head, tail
+
+    def stage_events(self, name, result, stages=None):
+        """The offset sorted events a single finished stage contributes, limited to `stages` (all by default)."""
+        stages = TIMELINE_STAGES if stages is None else stages
+        empty = np.empty(0, dtype=EVENT_DTYPE)
+        if name == "beats" and "beats" in stages:
+            return self.beat_events(result)
+        if name == "visemes" and "visemes" in stages:
+            return self.viseme_events(result)
+        if name == "words" and "words" in stages:
+            return self.word_events(result)[0]
+        if name == "activity" and "emotes" in stages:
+            return merge_sorted(self.activity_emote_events(result))
+        return empty
+
+    def to_dicts(self, events=None):
+        events = self.events if events is None else events
+        values = self.strings.values
+        data = []
+        for offset, time, length, type, index in events.tolist():
+            event = {"data": values[index], "time": time}
+            if length != NO_LENGTH:
+                event["length"] = length
+            event["type"] = EVENT_TYPES[type]
+            event["offset"] = offset
+            data.append(event)
+        return data
+
+    @classmethod
+    def from_dicts(cls, data, sample_rate=24000, channels=1):
+        # rebuild a timeline from serialized events (a cached result for example), keeping their order
+        timeline = cls(sample_rate, channels)
+        events = timeline.make_events(
+            [event["time"] for event in data],
+            np.fromiter((TYPE_CODES[event["type"]] for event in data), dtype=np.uint8, count=len(data)),
+            [event["data"] for event in data],
+            [event.get("length", NO_LENGTH) for event in data]
+        )
+        events["offset"] = [event["offset"] for event in data]
+        timeline.events = events
+        return timeline
+
+
+def build_timeline(beats, transcript_times, visemes, sample_rate=24000, channels=1, stages=None, activity=None):
+    """
+    Timeline of the events of `stages` (all of TIMELINE_STAGES by default). Results of models that didn't run
+    are None. The emotes follow the vocal `activity` segments, or the gaps between words without them.
+    """
+    stages = TIMELINE_STAGES if stages is None else stages
+    timeline = Timeline(sample_rate, channels)
+    empty = np.empty(0, dtype=EVENT_DTYPE)
+
+    words, word_times = empty, np.empty(0, dtype=np.int64)
+    if transcript_times is not None:
+        words, word_times = timeline.word_events(transcript_times)
+    emotes_head, emotes_tail = empty, empty
+    if "emotes" in stages:
+        if activity is not None:
+            emotes_head, emotes_tail = timeline.activity_emote_events(activity)
+        else:
+            emotes_head, emotes_tail = timeline.emote_events(word_times)
+
+    # same order as a stable sort of head emotes, beats, words, visemes and tail emotes
+    timeline.events = merge_sorted([
+        emotes_head,
+        timeline.beat_events(beats) if beats is not None and "beats" in stages else empty,
+        words if "words" in stages else empty,
+        timeline.viseme_events(visemes) if visemes is not None and "visemes" in stages else empty,
+        emotes_tail,
+    ])
+    return timeline
+
+
+# Fixed width little-endian records of the binary timeline encoding, 8 byte aligned
+BINARY_RECORD_DTYPE = np.dtype({
+    "names": ["offset", "time", "length", "data", "type"],
+    "formats": ["<i8", "<i4", "<i4", "<u4", "u1"],
+    "offsets": [0, 8, 12, 16, 20],
+    "itemsize": 24,
+})
+BINARY_COUNTS_DTYPE = np.dtype("<u4")
+
+
+def encode_binary(timeline):
+    """
+    Binary timeline encoding:
+        uint32 string count, uint32 record count
+        per string: uint32 byte length, utf-8 bytes
+        zero padding up to a multiple of 8 bytes
+        records: int64 offset, int32 time ms, int32 length ms (-1 for none), uint32 string index, uint8 type, 3 padding bytes
+    All integers are little-endian. Non-string data (beat numbers) is stored as its text.
+    """
+    strings = [value if isinstance(value, str) else repr(value) for value in timeline.strings.values]
+    encoded_strings = [value.encode("utf-8") for value in strings]
+
+    parts = [np.array([len(encoded_strings), len(timeline.events)], dtype=BINARY_COUNTS_DTYPE).tobytes()]
+    for value in encoded_strings:
+        parts.append(np.array([len(value)], dtype=BINARY_COUNTS_DTYPE).tobytes())
+        parts.append(value)
+    size = sum(len(part) for part in parts)
+    parts.append(b"\0" * (-size % 8))
+
+    records = np.zeros(len(timeline.events), dtype=BINARY_RECORD_DTYPE)
+    for name in BINARY_RECORD_DTYPE.names:
+        records[name] = timeline.events[name]
+    parts.append(records.tobytes())
+
+    return b"".join(parts)
+
+
+def decode_binary(buffer):
+    """Inverse of encode_binary. Returns the string table and the records as a view into `buffer`."""
+    string_count, record_count = np.frombuffer(buffer, dtype=BINARY_COUNTS_DTYPE, count=2)
+    position = 8
+    strings = []
+    for _ in range(string_count):
+        length = int(np.frombuffer(buffer, dtype=BINARY_COUNTS_DTYPE, count=1, offset=position)[0])
+        position += 4
+        strings.append(bytes(buffer[position:position + length]).decode("utf-8"))
+        position += length
+    position += -position % 8
+    records = np.frombuffer(buffer, dtype=BINARY_RECORD_DTYPE, count=int(record_count), offset=position)
+    return strings, records
@@ -1,21 +1,68 @@
 import re
 
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 import uvicorn
 import os
+import numpy as np
 import torch
 import shutil
-from whisper import load_model
 from typing import List, Dict, Union, Optional
 
 # Create FastAPI instance as a global variable for sharing across multiple files
 from app import app
+from inference_executor import run_inference
+from metrics import audio_duration, measure
+from model_registry import registry
+from vocal_activity import compact
+
+# Whisper model size used unless a request asks for another one of WHISPER_MODELS
+WHISPER_MODEL = os.environ.get("LIPSYNC_WHISPER_MODEL", "base")
+WHISPER_MODELS = os.environ.get("LIPSYNC_WHISPER_MODELS", "tiny,base,small,medium").split(",")
+
+# Whisper decodes 30 second windows at 16kHz, clips shorter than that are packed into one window with
+# PACK_GAP_SECONDS of silence between them so they share a single decoding pass
+WHISPER_SAMPLE_RATE = 16000
+WHISPER_WINDOW_SECONDS = 30.0
+PACK_GAP_SECONDS = 1.0
+
+
+def load_whisper(size):
+    from whisper import load_model
+    return load_model(size)
+
+
+# Loaded on first use or during warmup
+registry.register("whisper", load_whisper, default=WHISPER_MODEL, variants=list(dict.fromkeys(WHISPER_MODELS + [WHISPER_MODEL])))
+
+
+def transcribe_file_sync(temp_path: str, transcript: Optional[str] = None, whisper_model: Optional[str] = None, voiced: Optional[List[List[float]]] = None) -> List[Dict[str, Union[str, float]]]:
+    if voiced is None:
+        # Whisper decodes the whole file itself
+        return transcribe_wave_sync(temp_path, transcript, whisper_model)
+    import librosa
+    wave, _ = librosa.load(temp_path, sr=WHISPER_SAMPLE_RATE, mono=True)
+    return transcribe_wave_sync(wave, transcript, whisper_model, voiced)
+
+
+def transcribe_wave_sync(wave: Union[str, np.ndarray], transcript: Optional[str] = None, whisper_model: Optional[str] = None, voiced: Optional[List[List[float]]] = None) -> List[Dict[str, Union[str, float]]]:
+    """
+    transcribe_file_sync() of 16kHz mono float32 samples already in memory, which Whisper takes without decoding
+    or resampling anything. A path is passed on to Whisper as it is, without voiced segments only.
+    """
+    model = registry.get("whisper", whisper_model)
+    # Whisper installs decoding hooks on the model while transcribing, so only one transcription may use it at a time
+    model_lock = registry.inference_lock("whisper", whisper_model)
+
+    # with the voiced segments known, only they are transcribed and the word times are mapped back
+    audio = wave if isinstance(wave, str) else np.asarray(wave, dtype=np.float32)
+    seconds = audio_duration(wave) if isinstance(wave, str) else len(wave) / WHISPER_SAMPLE_RATE
+    to_original = None
+    if voiced is not None:
+        audio, to_original = compact(wave, WHISPER_SAMPLE_RATE, voiced)
+        seconds = len(audio) / WHISPER_SAMPLE_RATE
+    # nothing to transcribe when no part of the vocals is voiced
+    has_voice = voiced is None or len(audio) > 0
 
-# Load the Whisper model once during startup
-model = load_model("base")  # You can replace "base" with any other model size you have downloaded
-
-
-async def transcribe_file(temp_path: str, transcript: Optional[str] = None) -> List[Dict[str, Union[str, float]]]:
     # Load the audio file and perform transcription or forced alignment
     if transcript:
         # replace any spaces in text between [.*] with a _ use regex to capture anything between the square brackets and replace any spaces that were captured
@@ -23,10 +70,18 @@ async def transcribe_file(temp_path: str, transcript: Optional[str] = None) -> L
 
         print("Processed Transcript: ", processed_transcript)
         # Use forced alignment mode by specifying the transcript
-        result = model.transcribe(temp_path, word_timestamps=True, initial_prompt=processed_transcript)
+        with model_lock, measure("whisper", seconds):
+            result = model.transcribe(audio, word_timestamps=True, initial_prompt=processed_transcript) if has_voice else {"segments": []}
     else:
         # Perform full transcription
-        result = model.transcribe(temp_path, word_timestamps=True)
+        with model_lock, measure("whisper", seconds):
+            result = model.transcribe(audio, word_timestamps=True) if has_voice else {"segments": []}
+
+    if to_original is not None:
+        for segment in result["segments"]:
+            for word in segment["words"]:
+                word["start"] = to_original(word["start"])
+                word["end"] = to_original(word["end"])
 
     # Prepare the response data
     words_with_timestamps = []
@@ -58,11 +113,94 @@ async def transcribe_file(temp_path: str, transcript: Optional[str] = None) -> L
     return words_with_timestamps
 
 
+def transcribe_files_sync(clips: List[Union[str, np.ndarray]], whisper_model: Optional[str] = None) -> List[List[Dict[str, Union[str, float]]]]:
+    """
+    Transcribe several clips without transcripts, packing short ones into shared Whisper windows. Clips are paths
+    or 16kHz mono float32 samples. Returns the words of every clip in order, timed from the start of that clip.
+    """
+    import librosa
+
+    results = [None] * len(clips)
+    packs = [[]]
+    pack_seconds = 0
+    for i, clip in enumerate(clips):
+        wave = librosa.load(clip, sr=WHISPER_SAMPLE_RATE, mono=True)[0] if isinstance(clip, str) else clip
+        seconds = len(wave) / WHISPER_SAMPLE_RATE + PACK_GAP_SECONDS
+        if seconds > WHISPER_WINDOW_SECONDS:
+            # too long to share a window
+            results[i] = transcribe_wave_sync(wave, whisper_model=whisper_model)
+            continue
+        if pack_seconds + seconds > WHISPER_WINDOW_SECONDS:
+            packs.append([])
+            pack_seconds = 0
+        packs[-1].append((i, wave))
+        pack_seconds += seconds
+
+    model = registry.get("whisper", whisper_model)
+    model_lock = registry.inference_lock("whisper", whisper_model)
+    gap = np.zeros(int(PACK_GAP_SECONDS * WHISPER_SAMPLE_RATE), dtype=np.float32)
+    for pack in packs:
+        if not pack:
+            continue
+
+        # where each clip starts and ends in the packed audio, in seconds
+        pieces = []
+        bounds = []
+        position = 0
+        for i, wave in pack:
+            bounds.append((i, position / WHISPER_SAMPLE_RATE, (position + len(wave)) / WHISPER_SAMPLE_RATE))
+            pieces += [wave, gap]
+            position += len(wave) + len(gap)
+            results[i] = []
+        packed = np.concatenate(pieces).astype(np.float32)
+
+        with model_lock, measure("whisper", len(packed) / WHISPER_SAMPLE_RATE):
+            result = model.transcribe(packed, word_timestamps=True)
+
+        # a word belongs to the clip its middle falls in, half of the silence on either side counts for the clip
+        for segment in result["segments"]:
+            for word in segment["words"]:
+                middle = (word["start"] + word["end"]) / 2
+                for i, start, end in bounds:
+                    if start - PACK_GAP_SECONDS / 2 <= middle < end + PACK_GAP_SECONDS / 2:
+                        results[i].append({
+                            "word": word["word"],
+                            "start": str(min(max(word["start"] - start, 0.0), end - start)),
+                            "end": str(min(max(word["end"] - start, 0.0), end - start))
+                        })
+                        break
+
+    return results
+
+
+async def transcribe_files(clips: List[Union[str, np.ndarray]], whisper_model: Optional[str] = None) -> List[List[Dict[str, Union[str, float]]]]:
+    await registry.get_async("whisper", whisper_model)
+    return await run_inference("whisper", transcribe_files_sync, clips, whisper_model)
+
+
+async def transcribe_file(temp_path: str, transcript: Optional[str] = None, whisper_model: Optional[str] = None, voiced: Optional[List[List[float]]] = None) -> List[Dict[str, Union[str, float]]]:
+    # load a model that isn't in memory yet off the inference pool, so transcriptions queued there keep going
+    await registry.get_async("whisper", whisper_model)
+    return await run_inference("whisper", transcribe_file_sync, temp_path, transcript, whisper_model, voiced)
+
+
+async def transcribe_wave(wave: np.ndarray, transcript: Optional[str] = None, whisper_model: Optional[str] = None, voiced: Optional[List[List[float]]] = None) -> List[Dict[str, Union[str, float]]]:
+    # transcribe_file() of 16kHz mono samples in memory
+    await registry.get_async("whisper", whisper_model)
+    return await run_inference("whisper", transcribe_wave_sync, wave, transcript, whisper_model, voiced)
+
+
 @app.post("/transcribe/")
 async def transcribe_audio(
         file: UploadFile = File(...),
-        transcript: Optional[str] = Form(None)  # Optional transcript input for forced alignment
+        transcript: Optional[str] = Form(None),  # Optional transcript input for forced alignment
+        whisper_model: Optional[str] = Form(None)  # Optional Whisper model size, one of WHISPER_MODELS
 ) -> List[Dict[str, Union[str, float]]]:
+    try:
+        registry.resolve("whisper", whisper_model)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     # Save the uploaded file temporarily
     temp_dir = "uploads"
     if not os.path.exists(temp_dir):
@@ -73,7 +211,7 @@ async def transcribe_audio(
         shutil.copyfileobj(file.file, f)
 
     # Call the transcribe_file function
-    words_with_timestamps = await transcribe_file(temp_path, transcript)
+    words_with_timestamps = await transcribe_file(temp_path, transcript, whisper_model)
 
     # Delete the temporary audio file
     os.remove(temp_path)
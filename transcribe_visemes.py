@@ -1,28 +1,45 @@
 from fastapi import FastAPI, File, UploadFile
 import uvicorn
 import tempfile
+import threading
 import os
-from allosaurus.app import read_recognizer, download_model
-from allosaurus.model import get_model_path
-from allosaurus.lm.inventory import Inventory
 import torch
 import shutil
-from whisper import load_model
-from typing import List, Dict
+from typing import List, Dict, Optional
+
+import librosa
+import numpy as np
+import soundfile as sf
 
 from app import app
+from inference_executor import run_inference
+from metrics import audio_duration, measure
+from model_registry import registry
+from vocal_activity import compact
 
-# Download the Allosaurus English model if not already present
+# The Allosaurus English-only model
 model_name = "eng2102"
-download_model(model_name)
 
-# Initialize the Allosaurus recognizer with the English-only model
-recognizer = read_recognizer(model_name)
 
-# List the phonemes supported by the model using Inventory
-inventory = Inventory(get_model_path(model_name))
-supported_phonemes = list(inventory.unit.id_to_unit.values())[1:]
-print("Supported Phonemes:", ' '.join(supported_phonemes))
+def load_recognizer():
+    from allosaurus.app import read_recognizer, download_model
+    from allosaurus.model import get_model_path
+    from allosaurus.lm.inventory import Inventory
+
+    # Download the Allosaurus English model if not already present
+    download_model(model_name)
+    recognizer = read_recognizer(model_name)
+
+    # List the phonemes supported by the model using Inventory
+    inventory = Inventory(get_model_path(model_name))
+    supported_phonemes = list(inventory.unit.id_to_unit.values())[1:]
+    print("Supported Phonemes:", ' '.join(supported_phonemes))
+    return recognizer
+
+
+# Loaded on first use or during warmup
+registry.register("allosaurus", load_recognizer)
+recognizer_lock = threading.Lock()
 
 # Define the phoneme-to-viseme mapping based on OVRLipSync reference
 phoneme_to_viseme = {
@@ -66,16 +83,58 @@ phoneme_to_viseme = {
     'θ': 'TH'
 }
 
-async def transcribe_visemes(audio_path: str):
+# Rate of the samples recognized from memory, Allosaurus resamples to what its model wants anyway
+VOICED_SAMPLE_RATE = 16000
+
+
+def transcribe_visemes_sync(audio_path: str, voiced: Optional[List[List[float]]] = None):
     # Perform phoneme recognition using Allosaurus with timestamps
-    results = recognizer.recognize(audio_path, timestamp=True).splitlines()
+    if voiced is not None:
+        wave, _ = librosa.load(audio_path, sr=VOICED_SAMPLE_RATE, mono=True)
+        return transcribe_visemes_wave_sync(wave, voiced)
+
+    recognizer = registry.get("allosaurus")
+    with recognizer_lock, measure("allosaurus", audio_duration(audio_path)):
+        results = recognizer.recognize(audio_path, timestamp=True).splitlines()
+    return phoneme_result(results)
+
+
+def transcribe_visemes_wave_sync(wave, voiced: Optional[List[List[float]]] = None, sample_rate: int = VOICED_SAMPLE_RATE):
+    """transcribe_visemes_sync() of mono float32 samples in memory, such as the vocals of a separation."""
+    recognizer = registry.get("allosaurus")
+    to_original = None
+    if voiced is not None:
+        # only the voiced segments are recognized, the phoneme times are mapped back
+        wave, to_original = compact(wave, sample_rate, voiced)
+    if not len(wave):
+        return phoneme_result([])
 
+    with recognizer_lock, measure("allosaurus", len(wave) / sample_rate):
+        results = recognize_wave(recognizer, wave, sample_rate).splitlines()
+    return phoneme_result(results, to_original)
+
+
+def recognize_wave(recognizer, wave, sample_rate: int):
+    # Allosaurus only reads paths ending in .wav, so the samples go through a temporary 16 bit file rather than
+    # its internals
+    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as wave_file:
+        wave_path = wave_file.name
+    try:
+        sf.write(wave_path, wave, sample_rate, subtype="PCM_16")
+        return recognizer.recognize(wave_path, timestamp=True)
+    finally:
+        os.remove(wave_path)
+
+
+def phoneme_result(results, to_original=None):
     # Collect phonemes, their timestamps, and corresponding visemes
     phoneme_data = []
     for result in results:
         parts = result.split()
         if len(parts) == 3:
             start_time = float(parts[0])
+            if to_original is not None:
+                start_time = to_original(start_time)
             duration = float(parts[1])
             phoneme = parts[2]
             end_time = start_time + duration
@@ -89,6 +148,14 @@ async def transcribe_visemes(audio_path: str):
 
     return {"transcription": phoneme_data}
 
+
+async def transcribe_visemes(audio_path: str, voiced: Optional[List[List[float]]] = None):
+    return await run_inference("allosaurus", transcribe_visemes_sync, audio_path, voiced)
+
+
+async def transcribe_visemes_wave(wave, voiced: Optional[List[List[float]]] = None, sample_rate: int = VOICED_SAMPLE_RATE):
+    return await run_inference("allosaurus", transcribe_visemes_wave_sync, wave, voiced, sample_rate)
+
 @app.post("/transcribe-to-phonemes/")
 async def transcribe_to_phonemes(file: UploadFile = File(...)):
     """
@@ -105,6 +172,3 @@ async def transcribe_to_phonemes(file: UploadFile = File(...)):
     os.remove(audio_path)
 
     return visemes
-
-# Load the Whisper model once during startup
-model = load_model("base")  # You can replace "base" with any other model size you have downloaded
\ No newline at end of file
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import struct
+import uuid
+
+import soundfile as sf
+from fastapi import HTTPException, UploadFile
+from pydub.utils import mediainfo
+
+from app import log
+
+UPLOADS_DIR = 'uploads'
+# Uploads bigger or longer than these are rejected before any decoding or model work
+MAX_UPLOAD_BYTES = int(os.environ.get("LIPSYNC_MAX_UPLOAD_MB", 200)) * 1024 * 1024
+MAX_UPLOAD_SECONDS = float(os.environ.get("LIPSYNC_MAX_UPLOAD_SECONDS", 30 * 60))
+CHUNK_SIZE = 1024 * 1024
+# Enough of the file for a WAV or FLAC header, which declares the length of the audio
+PROBE_BYTES = 64 * 1024
+
+
+class SpooledUpload(object):
+    """An upload written to disk in chunks, with the sha256 of its bytes and its duration when known."""
+
+    def __init__(self, path, content_hash, size, duration):
+        self.path = path
+        self.content_hash = content_hash
+        self.size = size
+        self.duration = duration
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.remove()
+
+
+def probe_header_duration(header):
+    """
+    Duration declared by a WAV or FLAC header, or None. Works on the first bytes of a file that is still
+    arriving, where libsndfile would only count the samples written so far.
+    """
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        byte_rate = None
+        position = 12
+        while position + 8 <= len(header):
+            chunk_id = header[position:position + 4]
+            chunk_size = struct.unpack('<I', header[position + 4:position + 8])[0]
+            if chunk_id == b'fmt ' and position + 20 <= len(header):
+                byte_rate = struct.unpack('<I', header[position + 16:position + 20])[0]
+            elif chunk_id == b'data':
+                # streamed WAVs leave the size at 0 or 0xFFFFFFFF
+                if byte_rate and 0 < chunk_size < 0xFFFFFFFF:
+                    return chunk_size / byte_rate
+                return None
+            position += 8 + chunk_size + (chunk_size & 1)
+    elif header[:4] == b'fLaC' and len(header) >= 8 + 18 and header[4] & 0x7f == 0:
+        # STREAMINFO: 20 bit sample rate, 3 bit channels, 5 bit depth, 36 bit total samples
+        packed = int.from_bytes(header[8 + 10:8 + 18], 'big')
+        sample_rate = packed >> 44
+        total_samples = packed & ((1 << 36) - 1)
+        if sample_rate and total_samples:
+            return total_samples / sample_rate
+    return None
+
+
+def probe_duration(path):
+    # only for complete files: soundfile reads the container without a subprocess, ffprobe handles the rest
+    try:
+        info = sf.info(path)
+        if info.frames > 0:
+            return info.frames / info.samplerate
+    except Exception:
+        pass
+    return probe_duration_ffprobe(path)
+
+
+def probe_duration_ffprobe(path):
+    try:
+        return float(mediainfo(path).get("duration"))
+    except Exception:
+        return None
+
+
+def check_duration(duration, max_seconds, filename):
+    if duration is not None and duration > max_seconds:
+        raise HTTPException(
+            status_code=413,
+            detail=f"{filename} is {duration:.0f}s long, the limit is {max_seconds:.0f}s"
+        )
+
+
+async def spool_upload(file: UploadFile, max_bytes=None, max_seconds=None, suffix=""):
+    """
+    Stream an upload to a spool file without holding it in memory, hashing it as the chunks arrive. Uploads
+    over `max_bytes` or longer than `max_seconds` raise a 413 as soon as that is known.
+    """
+    max_bytes = MAX_UPLOAD_BYTES if max_bytes is None else max_bytes
+    max_seconds = MAX_UPLOAD_SECONDS if max_seconds is None else max_seconds
+
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    path = os.path.join(UPLOADS_DIR, f'{uuid.uuid4().hex}{suffix}')
+    content_hash = hashlib.sha256()
+    size = 0
+    duration = None
+    header = b''
+
+    try:
+        with open(path, 'wb') as f:
+            while True:
+                chunk = await file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"{file.filename} is larger than the {max_bytes // (1024 * 1024)}MB limit"
+                    )
+                content_hash.update(chunk)
+                f.write(chunk)
+
+                # as soon as the header is in, check the length it declares
+                if header is not None and duration is None:
+                    header += chunk[:PROBE_BYTES - len(header)]
+                    duration = probe_header_duration(header)
+                    check_duration(duration, max_seconds, file.filename)
+                    if len(header) >= PROBE_BYTES:
+                        header = None
+
+        if duration is None:
+            duration = probe_duration(path)
+            check_duration(duration, max_seconds, file.filename)
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    log("upload", f"Spooled {file.filename}: {size} bytes, sha256 {content_hash.hexdigest()}, "
+                  f"{'unknown' if duration is None else f'{duration:.1f}s'}")
+    return SpooledUpload(path, content_hash.hexdigest(), size, duration)
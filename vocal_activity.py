@@ -0,0 +1,104 @@
+import json
+import os
+
+import numpy as np
+
+# Where the separated vocals are active. A voiced segment starts once the smoothed vocal energy rises above
+# ACTIVITY_ON_DB, relative to the loudest frame of the song, and lasts until it falls below ACTIVITY_OFF_DB
+ACTIVITY_ON_DB = float(os.environ.get("LIPSYNC_ACTIVITY_ON_DB", -35))
+ACTIVITY_OFF_DB = float(os.environ.get("LIPSYNC_ACTIVITY_OFF_DB", -45))
+SMOOTHING_SECONDS = 0.25
+# Breaks shorter than this are bridged, blips shorter than this are dropped
+MIN_GAP_SECONDS = 1.0
+MIN_SEGMENT_SECONDS = 0.2
+# Segments are widened so soft word onsets and tails aren't cut off
+PAD_SECONDS = 0.25
+# Silence between the segments joined by compact(), so words on either side of a break don't run together
+COMPACT_GAP_SECONDS = 0.5
+
+
+def energy_db(energy, frame_seconds):
+    """Per-frame vocal energy smoothed over SMOOTHING_SECONDS, in dB below the loudest frame."""
+    energy = np.asarray(energy, dtype=np.float64)
+    width = max(1, int(round(SMOOTHING_SECONDS / frame_seconds)))
+    smoothed = np.convolve(energy, np.ones(width) / width, mode="same")
+    peak = smoothed.max() if len(smoothed) else 0
+    if peak <= 0:
+        return np.full(len(smoothed), -np.inf)
+    return 10 * np.log10(np.maximum(smoothed / peak, 1e-12))
+
+
+def activity_segments(energy, frame_seconds, on_db=None, off_db=None):
+    """[start, end] seconds of every voiced segment, from the per-frame energy of the separated vocals."""
+    on_db = ACTIVITY_ON_DB if on_db is None else on_db
+    off_db = ACTIVITY_OFF_DB if off_db is None else off_db
+    levels = energy_db(energy, frame_seconds)
+
+    # hysteresis, so energy hovering around a single threshold doesn't flicker on and off
+    segments = []
+    start = None
+    for frame, level in enumerate(levels):
+        if start is None and level >= on_db:
+            start = frame
+        elif start is not None and level < off_db:
+            segments.append([start, frame])
+            start = None
+    if start is not None:
+        segments.append([start, len(levels)])
+
+    duration = len(levels) * frame_seconds
+    merged = []
+    for start, end in segments:
+        start = max(0.0, start * frame_seconds - PAD_SECONDS)
+        end = min(duration, end * frame_seconds + PAD_SECONDS)
+        if merged and start - merged[-1][1] < MIN_GAP_SECONDS:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [[round(start, 3), round(end, 3)] for start, end in merged if end - start >= MIN_SEGMENT_SECONDS]
+
+
+def save_segments(path, segments):
+    with open(path, "w") as f:
+        json.dump(segments, f)
+
+
+def load_segments(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class TimeMap(object):
+    """Maps a time in audio made by compact() back to the same moment in the original audio."""
+
+    def __init__(self, starts, lengths, gap):
+        self.starts = np.asarray(starts, dtype=np.float64)
+        self.lengths = np.asarray(lengths, dtype=np.float64)
+        self.compact_starts = np.concatenate([[0.0], np.cumsum(self.lengths + gap)[:-1]])
+
+    def __call__(self, seconds):
+        if not len(self.starts):
+            return seconds
+        i = max(0, int(np.searchsorted(self.compact_starts, seconds, side="right")) - 1)
+        # times in the silence after a segment belong to its end
+        return float(self.starts[i] + min(max(seconds - self.compact_starts[i], 0.0), self.lengths[i]))
+
+
+def compact(wave, sample_rate, segments, gap=COMPACT_GAP_SECONDS):
+    """
+    Only the voiced `segments` of a mono `wave`, joined by `gap` seconds of silence, so recognizers don't spend
+    time on the instrumental parts. Returns the joined audio and the TimeMap back to the original times.
+    """
+    silence = np.zeros(int(gap * sample_rate), dtype=np.float32)
+    pieces = []
+    starts = []
+    lengths = []
+    for start, end in segments:
+        piece = wave[int(start * sample_rate):int(end * sample_rate)]
+        if not len(piece):
+            continue
+        pieces += [piece.astype(np.float32), silence]
+        starts.append(int(start * sample_rate) / sample_rate)
+        lengths.append(len(piece) / sample_rate)
+    joined = np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.float32)
+    return joined, TimeMap(starts, lengths, len(silence) / sample_rate)
@@ -1,6 +1,5 @@
-import hashlib
+import glob
 import traceback
-import argparse
 
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.responses import StreamingResponse
@@ -13,16 +12,22 @@ import soundfile as sf
 import torch
 
 from pathlib import Path
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 import zipfile
 
 from vocal_remover.lib import nets
 from vocal_remover.lib import spec_utils
 
-from typing import List
-from vocal_remover.inference import Separator
+from typing import List, Union
+from vocal_remover.inference import STEMS, Separator
 
 from app import app
+from decoded_audio import DecodedAudio
+from inference_executor import run_inference
+from metrics import measure, record_patches
+from model_registry import registry
+from uploads import UPLOADS_DIR, spool_upload
+from vocal_activity import activity_segments, load_segments, save_segments
 
 MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../models')
 DEFAULT_MODEL_PATH = os.path.join(MODEL_DIR, 'baseline.pth')
@@ -30,87 +35,396 @@ device = torch.device('cpu')
 if torch.cuda.is_available():
     device = torch.device(f'cuda:0')
 
-p = argparse.ArgumentParser()
-p.add_argument('--init', '-i', action='store_true')
-p.add_argument('--gpu', '-g', type=int, default=-1)
-p.add_argument('--pretrained_model', '-P', type=str, default=DEFAULT_MODEL_PATH)
-p.add_argument('--sr', '-r', type=int, default=44100)
-p.add_argument('--n_fft', '-f', type=int, default=2048)
-p.add_argument('--hop_length', '-H', type=int, default=1024)
-p.add_argument('--batchsize', '-B', type=int, default=4)
-p.add_argument('--cropsize', '-c', type=int, default=256)
-p.add_argument('--output_image', '-I', action='store_true')
-p.add_argument('--tta', '-t', action='store_true')
-p.add_argument('--complex', '-X', action='store_true')
-args = p.parse_args()
-model = nets.CascadedNet(args.n_fft, args.hop_length, 32, 128, args.complex)
-model.load_state_dict(torch.load(args.pretrained_model, map_location='cpu'))
-model.to(device)
-
-# Function to extract vocals from an audio file
-def get_vocals(audio_file_path: str, n_fft: int = 2048, hop_length: int = 512, sr: int = 44100, batchsize: int = 4, cropsize: int = 512, tta: bool = False) -> List[str]:
-    try:
-        basename = os.path.splitext(os.path.basename(audio_file_path))[0]
-        output_dir = './output_vocals/'
-        Path(output_dir).mkdir(exist_ok=True)
-
-        instruments_path = f'{output_dir}{basename}_Instruments.wav'
-        vocals_path = f'{output_dir}{basename}_Vocals.wav'
-        print("Getting vocals for file:", audio_file_path)
-
-        # if vocals exists return it
-        if os.path.exists(vocals_path):
-            return [vocals_path, instruments_path]
+# Separation model settings, the same defaults the command line flags used to have
+SEPARATION_MODEL_PATH = os.environ.get("LIPSYNC_SEPARATION_MODEL", DEFAULT_MODEL_PATH)
+SEPARATION_N_FFT = 2048
+SEPARATION_HOP_LENGTH = 1024
+SEPARATION_COMPLEX = False
+# Patches this many dB below the loudest bin of the song skip the model, an empty value runs every patch
+SEPARATION_SILENCE_THRESHOLD = os.environ.get("LIPSYNC_SILENCE_THRESHOLD_DB", "-90")
+SEPARATION_SILENCE_THRESHOLD = float(SEPARATION_SILENCE_THRESHOLD) if SEPARATION_SILENCE_THRESHOLD else None
+# STFT and inverse STFT implementation, one of spec_utils.STFT_BACKENDS. torch transforms both channels in one
+# call on its own threads, the results agree with librosa to float32 precision.
+SEPARATION_STFT_BACKEND = os.environ.get("LIPSYNC_STFT_BACKEND", "librosa")
+if SEPARATION_STFT_BACKEND not in spec_utils.STFT_BACKENDS:
+    raise ValueError(f"LIPSYNC_STFT_BACKEND must be one of {', '.join(spec_utils.STFT_BACKENDS)}")
+# Songs longer than this are separated block by block in constant memory, 0 separates every song in one piece
+SEPARATION_STREAM_SECONDS = float(os.environ.get("LIPSYNC_STREAM_SEPARATION_SECONDS", 600))
+# Patches the model runs on per block of a streamed separation, and spectrogram frames per read of its peak pass
+SEPARATION_STREAM_BLOCK_PATCHES = 8
+SEPARATION_STREAM_PEAK_FRAMES = 4096
+# Whisper and Allosaurus both work on 16kHz mono, the rate of the vocals separated with asr=True
+ASR_SAMPLE_RATE = 16000
+
+
+def default_separation_model():
+    return Path(SEPARATION_MODEL_PATH).stem
+
+
+def separation_models():
+    # every checkpoint in the models folder by its file name without .pth, plus the one set on the command line
+    models = {Path(path).stem: path for path in sorted(glob.glob(os.path.join(MODEL_DIR, '*.pth')))}
+    models[default_separation_model()] = SEPARATION_MODEL_PATH
+    return models
+
+
+def load_separation_model(name):
+    state = torch.load(separation_models()[name], map_location='cpu')
+    # complex models predict a real and an imaginary mask per channel, twice the outputs of a magnitude model
+    is_complex = state['out.weight'].shape[0] == 8 if 'out.weight' in state else SEPARATION_COMPLEX
+    model = nets.CascadedNet(SEPARATION_N_FFT, SEPARATION_HOP_LENGTH, 32, 128, is_complex)
+    model.load_state_dict(state)
+    model.to(device)
+    return model
+
+
+# Loaded on first use or during warmup
+registry.register("separation", load_separation_model, default=default_separation_model, variants=lambda: list(separation_models()))
+
+def stem_paths(basename: str, vocal_model: str = None, activity: bool = False, stems=STEMS, asr: bool = False):
+    # stems of other models must not be mistaken for the ones of this model
+    if vocal_model:
+        basename = f'{basename}_{vocal_model}'
+    output_dir = './output_vocals/'
+    Path(output_dir).mkdir(exist_ok=True)
+    # vocals first, then instruments, None for a stem that isn't asked for
+    paths = [f'{output_dir}{basename}_{stem.capitalize()}.wav' if stem in stems else None for stem in STEMS]
+    if asr and paths[0]:
+        # the 16kHz mono vocals for the speech recognizers, see write_stems
+        paths[0] = f'{output_dir}{basename}_Vocals16k.wav'
+    if activity:
+        # the voiced segments of the vocals, see vocal_activity
+        paths.append(f'{output_dir}{basename}_Activity.json')
+    return paths
+
+
+class SeparatedStems(list):
+    """
+    The stem paths of a separation as stem_paths() lists them. The waves the separation made, (2, samples) or
+    flat for the mono ASR vocals, are kept under `waves` by stem name with their rates under `sample_rates`, so
+    callers can use them without reading the files back. The voiced segments found with `activity` are kept
+    under `segments` the same way.
+    """
+
+    def __init__(self, paths, waves=None, sample_rates=None, segments=None):
+        super().__init__(paths)
+        self.waves = waves or {}
+        self.sample_rates = sample_rates or {}
+        self.segments = segments
+
+    def wave(self, stem):
+        # read back from the file when the stem was separated by an earlier call, or streamed to disk
+        if stem not in self.waves:
+            wave, self.sample_rates[stem] = sf.read(self[STEMS.index(stem)], dtype='float32')
+            self.waves[stem] = wave.T
+        return self.waves[stem]
+
+    def activity(self):
+        if self.segments is None:
+            self.segments = load_segments(self[2])
+        return self.segments
+
+
+def write_stems(y_spec, v_spec, paths: List[str], hop_length: int, sr: int, duration: float, asr: bool = False, write: bool = True):
+    """
+    Inverse STFT of the stems whose spectrogram and path are both set, written to their paths unless `write` is
+    off. With `asr` the vocals are made at ASR_SAMPLE_RATE in mono straight from the spectrogram. Returns the
+    waves and their rates by name.
+    """
+    waves = {}
+    rates = {}
+    with measure("istft", duration):
+        for stem, spec, path in zip(STEMS, (v_spec, y_spec), paths):
+            if spec is None or path is None:
+                continue
+            if asr and stem == 'vocals':
+                waves[stem] = spec_utils.spectrogram_to_mono_wave(spec, hop_length, sr, ASR_SAMPLE_RATE, SEPARATION_STFT_BACKEND)
+                rates[stem] = ASR_SAMPLE_RATE
+            else:
+                waves[stem] = spec_utils.spectrogram_to_wave(spec, hop_length=hop_length, backend=SEPARATION_STFT_BACKEND)
+                rates[stem] = sr
+    if not write:
+        return waves, rates
+
+    with measure("write_stems", duration):
+        for stem, path in zip(STEMS, paths):
+            if stem in waves:
+                sf.write(path, waves[stem].T, rates[stem])
+    return waves, rates
+
+
+def find_activity(energy, path: str, hop_length: int, sr: int, duration: float, write: bool = True):
+    # the voiced segments of the vocals, saved to `path` unless `write` is off
+    with measure("activity", duration):
+        segments = activity_segments(energy, hop_length / sr)
+        if write:
+            save_segments(path, segments)
+    return segments
+
+
+def wave_reader(source, n_samples):
+    """
+    read(first, last) over the stereo samples of a (2, samples) array or an open sf.SoundFile, with zeros
+    outside the wave, for spec_utils.spectrogram_frames.
+    """
+    def read(first, last):
+        wave = np.zeros((2, last - first), dtype=np.float32)
+        start, end = max(first, 0), min(last, n_samples)
+        if start < end:
+            if isinstance(source, sf.SoundFile):
+                source.seek(start)
+                # mono files come back as one column, which broadcasts to both channels
+                wave[:, start - first:end - first] = source.read(end - start, dtype='float32', always_2d=True).T[:2]
+            else:
+                wave[:, start - first:end - first] = source[:, start:end]
+        return wave
+
+    return read
+
+
+def separate_stream(read, n_samples: int, sp: Separator, paths: List[str], n_fft: int, hop_length: int, sr: int, activity: bool, asr: bool = False, write: bool = True):
+    """
+    Separation of a long song block by block. Only one block of the spectrogram and the masks is held at a time,
+    the stems are overlap-added and written out as each block is done. Without `write` the stem samples are
+    collected in memory instead, which only stays small for the 16kHz mono vocals of `asr`. Returns the waves
+    kept in memory and their rates by name, like write_stems, and the voiced segments with `activity`.
+    """
+    n_frame = 1 + n_samples // hop_length
+    duration = n_samples / sr
+    stems = [stem for stem, path in zip(STEMS, paths) if path is not None]
+
+    def get_frames(start, end):
+        return spec_utils.spectrogram_frames(read, n_frame, start, end, hop_length, n_fft, SEPARATION_STFT_BACKEND)
+
+    # the model sees the spectrogram normalized to its loudest bin, finding it takes a first pass over the song
+    with measure("stft", duration):
+        peak = max(
+            np.abs(get_frames(start, min(n_frame, start + SEPARATION_STREAM_PEAK_FRAMES))).max()
+            for start in range(0, n_frame, SEPARATION_STREAM_PEAK_FRAMES)
+        )
 
-        # Loading wave source
-        X, sr = librosa.load(audio_file_path, sr=sr, mono=False, dtype=np.float32, res_type='kaiser_fast')
+    # written next to the stems and renamed once complete, so a failure never leaves half a stem to be reused
+    partial = {stem: f'{paths[STEMS.index(stem)]}.partial' for stem in stems} if write else {}
+    overlap_add = {stem: spec_utils.OverlapAdd(n_frame, hop_length, n_fft) for stem in stems}
+    # sample rate and channels of every stem file
+    formats = {stem: (sr, 2) for stem in stems}
+    if asr and 'vocals' in stems:
+        overlap_add['vocals'] = spec_utils.MonoOverlapAdd(n_frame, hop_length, n_fft, sr, ASR_SAMPLE_RATE)
+        formats['vocals'] = (ASR_SAMPLE_RATE, 1)
+    files = {}
+    chunks = {stem: [] for stem in stems}
+    energy = []
+
+    def output(stem, wave):
+        if write:
+            files[stem].write(wave.T)
+        else:
+            chunks[stem].append(wave)
 
-        if X.ndim == 1:
-            # mono to stereo
-            X = np.asarray([X, X])
+    try:
+        with measure("separate", duration):
+            for stem in partial:
+                files[stem] = sf.SoundFile(partial[stem], 'w', *formats[stem], format='WAV')
+            blocks = sp.separate_stream(
+                get_frames, n_frame, peak, SEPARATION_STREAM_BLOCK_PATCHES, tuple(stems) + (('vocals',) if activity else ())
+            )
+            for _, y_spec, v_spec in blocks:
+                for stem in stems:
+                    output(stem, overlap_add[stem].add(v_spec if stem == 'vocals' else y_spec))
+                if activity:
+                    energy.append(sp.vocal_energy(v_spec))
+            for stem in stems:
+                output(stem, overlap_add[stem].finish())
+                if write:
+                    files.pop(stem).close()
+        for stem in partial:
+            os.replace(partial[stem], paths[STEMS.index(stem)])
+    finally:
+        for stem in partial:
+            if stem in files:
+                files[stem].close()
+            if os.path.exists(partial[stem]):
+                os.unlink(partial[stem])
+
+    segments = find_activity(np.concatenate(energy), paths[2], hop_length, sr, duration, write) if activity else None
+    if write:
+        return {}, {}, segments
+    waves = {stem: np.concatenate(chunks[stem], axis=-1) for stem in stems}
+    return waves, {stem: formats[stem][0] for stem in stems}, segments
+
+
+# Function to extract vocals from an audio file, or from audio that was already decoded
+def get_vocals(audio_file_path: Union[str, DecodedAudio], n_fft: int = 2048, hop_length: int = 512, sr: int = 44100, batchsize: int = 4, cropsize: int = 512, tta: bool = False, vocal_model: str = None, activity: bool = False, stems=STEMS, asr: bool = False, write: bool = True) -> SeparatedStems:
+    """
+    Separates `stems`, a subset of STEMS, the others are neither computed nor written. With `asr` the vocals are
+    16kHz mono for the speech recognizers rather than full rate stereo. Returns the stem paths, with the waves of
+    this separation attached, see SeparatedStems. Without `write` the stems and the activity segments are only
+    kept in memory and every path is None.
+    """
+    try:
+        audio = audio_file_path if isinstance(audio_file_path, DecodedAudio) else None
+        if audio is not None:
+            basename = audio.name
+        else:
+            basename = os.path.splitext(os.path.basename(audio_file_path))[0]
+        paths = stem_paths(basename, vocal_model, activity, stems, asr)
+        print("Getting vocals for file:", basename if audio is not None else audio_file_path)
 
-        # STFT of wave source
-        X_spec = spec_utils.wave_to_spectrogram(X, hop_length, n_fft)
+        # if vocals exists return it
+        if all(os.path.exists(path) for path in paths if path is not None):
+            return SeparatedStems(paths)
 
         sp = Separator(
-            model=model,
+            model=registry.get("separation", vocal_model),
             device=device,
             batchsize=batchsize,
-            cropsize=cropsize
+            cropsize=cropsize,
+            silence_threshold=SEPARATION_SILENCE_THRESHOLD
         )
+        stream = SEPARATION_STREAM_SECONDS > 0 and not tta
+
+        # files already at the model sample rate are streamed straight from disk when they are long
+        info = None
+        if audio is None and stream:
+            try:
+                info = sf.info(audio_file_path)
+            except Exception:
+                pass
+        if info is not None and info.samplerate == sr and info.duration > SEPARATION_STREAM_SECONDS:
+            with sf.SoundFile(audio_file_path) as source:
+                waves, rates, segments = separate_stream(wave_reader(source, source.frames), source.frames, sp, paths, n_fft, hop_length, sr, activity, asr, write)
+            record_patches(sp.patches, sp.skipped_patches)
+            return SeparatedStems(paths if write else [None] * len(paths), waves, rates, segments)
 
-        if tta:
-            y_spec, v_spec = sp.separate_tta(X_spec)
+        # Loading wave source
+        if audio is not None:
+            X = audio.view(sr, 2)
         else:
-            y_spec, v_spec = sp.separate(X_spec)
+            X, sr = librosa.load(audio_file_path, sr=sr, mono=False, dtype=np.float32, res_type='kaiser_fast')
 
+        if X.ndim == 1:
+            # mono to stereo
+            X = np.asarray([X, X])
+        duration = X.shape[1] / sr
 
-        # Inverse STFT of instruments and vocals
-        wave = spec_utils.spectrogram_to_wave(y_spec, hop_length=hop_length)
-        sf.write(instruments_path, wave.T, sr)
-
-        wave = spec_utils.spectrogram_to_wave(v_spec, hop_length=hop_length)
-
-        sf.write(vocals_path, wave.T, sr)
+        if stream and duration > SEPARATION_STREAM_SECONDS:
+            # the wave is in memory already, its spectrogram and the stems still don't have to be
+            waves, rates, segments = separate_stream(wave_reader(X, X.shape[1]), X.shape[1], sp, paths, n_fft, hop_length, sr, activity, asr, write)
+            record_patches(sp.patches, sp.skipped_patches)
+            return SeparatedStems(paths if write else [None] * len(paths), waves, rates, segments)
 
-        return [vocals_path, instruments_path]
+        # STFT of wave source
+        with measure("stft", duration):
+            X_spec = spec_utils.wave_to_spectrogram(X, hop_length, n_fft, SEPARATION_STFT_BACKEND)
+
+        with measure("separate", duration):
+            if tta:
+                y_spec, v_spec = sp.separate_tta(X_spec, tuple(stems) + (('vocals',) if activity else ()))
+            else:
+                y_spec, v_spec = sp.separate(X_spec, stems=tuple(stems) + (('vocals',) if activity else ()))
+        record_patches(sp.patches, sp.skipped_patches)
+
+        waves, rates = write_stems(y_spec, v_spec, paths, hop_length, sr, duration, asr, write)
+        segments = None
+        if activity:
+            segments = find_activity(sp.vocal_energy(v_spec), paths[2], hop_length, sr, duration, write)
+
+        return SeparatedStems(paths if write else [None] * len(paths), waves, rates, segments)
     except Exception as e:
         traceback.print_exc()
         raise RuntimeError(f"Unexpected error: {e}")
 
 
+# Seconds of audio whose spectrograms are separated together by get_vocals_batch
+BATCH_SEPARATION_SECONDS = float(os.environ.get("LIPSYNC_BATCH_SEPARATION_SECONDS", 300))
+
+
+def get_vocals_batch(audios: List[DecodedAudio], n_fft: int = 2048, hop_length: int = 512, sr: int = 44100, batchsize: int = 4, cropsize: int = 512, vocal_model: str = None, activity: bool = False, stems=STEMS, asr: bool = False, write: bool = True) -> List[SeparatedStems]:
+    """
+    get_vocals() for many decoded clips. The separation patches of several clips share the model batches, up
+    to BATCH_SEPARATION_SECONDS of audio at a time. Returns the stems of every clip in order.
+    """
+    results = [SeparatedStems(stem_paths(audio.name, vocal_model, activity, stems, asr)) for audio in audios]
+
+    # clips whose stems exist already, or that appear twice in the batch, are only separated once
+    pending = {}
+    for audio, separated in zip(audios, results):
+        if not all(os.path.exists(path) for path in separated if path is not None):
+            pending.setdefault(audio.name, (audio, separated))
+    if not pending:
+        return results
+
+    sp = Separator(
+        model=registry.get("separation", vocal_model),
+        device=device,
+        batchsize=batchsize,
+        cropsize=cropsize,
+        silence_threshold=SEPARATION_SILENCE_THRESHOLD
+    )
+
+    groups = [[]]
+    group_seconds = 0
+    for audio, separated in pending.values():
+        if groups[-1] and group_seconds + audio.duration > BATCH_SEPARATION_SECONDS:
+            groups.append([])
+            group_seconds = 0
+        groups[-1].append((audio, separated))
+        group_seconds += audio.duration
+
+    for group in groups:
+        print(f"Getting vocals for {len(group)} clips")
+        X_specs = []
+        for audio, _ in group:
+            X = audio.view(sr, 2)
+            if X.ndim == 1:
+                X = np.asarray([X, X])
+            with measure("stft", audio.duration):
+                X_specs.append(spec_utils.wave_to_spectrogram(X, hop_length, n_fft, SEPARATION_STFT_BACKEND))
+
+        with measure("separate", sum(audio.duration for audio, _ in group)):
+            specs = sp.separate_batch(X_specs, return_energy=True, stems=tuple(stems))
+        record_patches(sp.patches, sp.skipped_patches)
+        sp.patches = sp.skipped_patches = 0
+
+        for (audio, separated), (y_spec, v_spec, energy) in zip(group, specs):
+            separated.waves, separated.sample_rates = write_stems(y_spec, v_spec, separated, hop_length, sr, audio.duration, asr, write)
+            if activity:
+                separated.segments = find_activity(energy, separated[2], hop_length, sr, audio.duration, write)
+            if not write:
+                separated[:] = [None] * len(separated)
+
+    # copies of a clip in the batch get the waves of the one that was separated
+    for i, audio in enumerate(audios):
+        if audio.name in pending:
+            results[i] = pending[audio.name][1]
+    return results
+
+
+async def separate_vocals(audio_file_path: Union[str, DecodedAudio], vocal_model: str = None, **kwargs) -> SeparatedStems:
+    # load a model that isn't in memory yet off the separation pool, so separations queued there keep going
+    await registry.get_async("separation", vocal_model)
+    # get_vocals on the separation pool so the request coroutine doesn't block the event loop
+    return await run_inference("separation", get_vocals, audio_file_path, vocal_model=vocal_model, **kwargs)
+
+
+async def separate_vocals_batch(audios: List[DecodedAudio], vocal_model: str = None, **kwargs) -> List[SeparatedStems]:
+    await registry.get_async("separation", vocal_model)
+    return await run_inference("separation", get_vocals_batch, audios, vocal_model=vocal_model, **kwargs)
+
+
 # Endpoint to handle uploading an audio file, extracting vocals, and streaming/download
 @app.post("/extract-vocals/")
 async def extract_vocals(uploaded_file: UploadFile = File(...), download: bool = False):
+    upload_dir = None
     try:
-        # get a name for the file based on the md5 of the file
-        name = hashlib.md5(uploaded_file.filename.encode()).hexdigest()
-        path = f'./uploads/{name}'
-        # write the file to disk
-        with open(f'./uploads/{name}', 'wb') as f:
-            f.write(await uploaded_file.read())
-
-        vocals_files = get_vocals(path)
+        # spool the upload to disk, named by the hash of its content so different songs never share stems. Each
+        # request gets its own folder, so removing the copy never pulls it from under a request for the same song
+        upload = await spool_upload(uploaded_file)
+        upload_dir = mkdtemp(dir=UPLOADS_DIR)
+        path = os.path.join(upload_dir, upload.content_hash)
+        os.replace(upload.path, path)
+
+        vocals_files = await separate_vocals(path, stems=("vocals",))
         if not vocals_files:
             raise HTTPException(status_code=404, detail="No vocals extracted.")
 
@@ -125,30 +439,28 @@ async def extract_vocals(uploaded_file: UploadFile = File(...), download: bool =
             })
         else:
             return StreamingResponse(iterfile(), media_type="audio/wav")
+    except HTTPException:
+        raise
     except Exception as e:
         # print the full exception
         print(e)
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
     finally:
-        #if tmp_path and os.path.exists(tmp_path):
-        #    os.unlink(tmp_path)
-        # Clean up any generated output
-        output_folder = Path("./output_vocals/") / Path(tmp_path).stem
-        #if output_folder.exists():
-        #    shutil.rmtree(output_folder)
+        # the vocals stay in output_vocals/ for the next request of the same song, the uploaded copy doesn't
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
 
 
 # Endpoint to handle uploading an audio file, extracting all tracks, and creating a zip file
 @app.post("/extract-tracks-zip/")
 async def extract_tracks_zip(uploaded_file: UploadFile = File(...)):
+    tmp_path = zip_path = None
     try:
-        with NamedTemporaryFile(delete=False) as tmp:
-            tmp.write(await uploaded_file.read())
-            tmp_path = tmp.name
+        tmp_path = (await spool_upload(uploaded_file)).path
 
         # Extract tracks (vocals and accompaniment) from the provided audio file
-        tracks_files = get_vocals(tmp_path, pretrained_model='models/baseline.pth', gpu=-1, n_fft=2048, hop_length=512, sr=44100, complex=True, batchsize=4, cropsize=512, tta=False)
+        tracks_files = await separate_vocals(tmp_path, n_fft=2048, hop_length=512, sr=44100, batchsize=4, cropsize=512, tta=False)
         if not tracks_files:
             raise HTTPException(status_code=404, detail="No tracks extracted.")
 
@@ -168,6 +480,8 @@ async def extract_tracks_zip(uploaded_file: UploadFile = File(...)):
         return StreamingResponse(iterfile(), headers={
             "Content-Disposition": f"attachment; filename={zip_filename}"
         }, media_type="application/zip")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     finally:
@@ -176,8 +490,8 @@ async def extract_tracks_zip(uploaded_file: UploadFile = File(...)):
         if zip_path and os.path.exists(zip_path):
             os.unlink(zip_path)
         # Clean up any generated output
-        output_folder = Path("./output_vocals/") / Path(tmp_path).stem
-        if output_folder.exists():
+        output_folder = Path("./output_vocals/") / Path(tmp_path or "").stem
+        if tmp_path and output_folder.exists():
             shutil.rmtree(output_folder)
 
 
@@ -13,61 +13,123 @@ from vocal_remover.lib import spec_utils
 from vocal_remover.lib import utils
 
 
+# Stems a separation can produce, in the order api.stem_paths lists them
+STEMS = ('vocals', 'instruments')
+
+
 class Separator(object):
 
-    def __init__(self, model, device=None, batchsize=1, cropsize=256):
+    def __init__(self, model, device=None, batchsize=1, cropsize=256, silence_threshold=None):
         self.model = model
         self.offset = model.offset
         self.device = device
         self.batchsize = batchsize
         self.cropsize = cropsize
         self.is_complex = model.is_complex
-
-    def _postprocess(self, X_spec, mask):
+        # patches whose region of interest has a mean power this many dB below the loudest bin of the
+        # spectrogram get a no-vocals mask without running the model, None runs the model on every patch
+        self.silence_threshold = silence_threshold
+        self.patches = 0
+        self.skipped_patches = 0
+
+    def _postprocess(self, X_spec, mask, stems=STEMS):
+        # only the stems asked for are computed, the others are None
+        y_spec = v_spec = None
         if self.is_complex:
-            y_spec = X_spec * mask[:2]
-            v_spec = X_spec * mask[2:]
+            if 'instruments' in stems:
+                y_spec = X_spec * mask[:2]
+            if 'vocals' in stems:
+                v_spec = X_spec * mask[2:]
         else:
             X_mag = np.abs(X_spec)
             X_phase = np.exp(1.j * np.angle(X_spec))
 
-            y_spec = X_mag * mask[:2] * X_phase
-            v_spec = X_mag * mask[2:] * X_phase
+            if 'instruments' in stems:
+                y_spec = X_mag * mask[:2] * X_phase
+            if 'vocals' in stems:
+                v_spec = X_mag * mask[2:] * X_phase
 
         return y_spec, v_spec
 
-    def _separate(self, X_spec_pad, roi_size):
-        X_dataset = []
-        patches = (X_spec_pad.shape[2] - 2 * self.offset) // roi_size
-        for i in range(patches):
-            start = i * roi_size
-            X_spec_crop = X_spec_pad[:, :, start:start + self.cropsize]
-            X_dataset.append(X_spec_crop)
+    @staticmethod
+    def vocal_energy(v_spec):
+        # energy of the separated vocals per frame, summed over channels and frequency bins
+        return np.sum(v_spec.real ** 2 + v_spec.imag ** 2, axis=(0, 1))
 
-        X_dataset = np.asarray(X_dataset)
+    def _windows(self, X_spec_pad, roi_size):
+        # strided (channels, bins, patches, cropsize) view of every patch, nothing is copied
+        patches = (X_spec_pad.shape[2] - 2 * self.offset) // roi_size
+        windows = np.lib.stride_tricks.sliding_window_view(X_spec_pad, self.cropsize, axis=2)
+        return windows[:, :, ::roi_size][:, :, :patches]
+
+    def _is_silent(self, patch, roi_size):
+        if self.silence_threshold is None:
+            return False
+        # the spectrograms are normalized to their loudest bin, so the power is relative to it
+        roi = patch[:, :, self.offset:self.offset + roi_size]
+        power = np.mean(roi.real ** 2 + roi.imag ** 2)
+        return power < 10 ** (self.silence_threshold / 10)
+
+    def _predict(self, X_specs_pad, roi_size):
+        """
+        Masks for every padded spectrogram in `X_specs_pad`. Batches are copied one at a time out of strided views
+        of the spectrograms, patches of consecutive spectrograms share batches, and the predicted masks are
+        written into one preallocated array per spectrogram. Silent patches are skipped, see silence_threshold.
+        """
+        windows = [self._windows(X_spec_pad, roi_size) for X_spec_pad in X_specs_pad]
+        # instrument mask channels first, then the vocal ones
+        channels = 2 * windows[0].shape[0]
+        masks = [
+            np.empty((channels, w.shape[1], w.shape[2] * roi_size), dtype=np.complex64 if self.is_complex else np.float32)
+            for w in windows
+        ]
+        total = sum(w.shape[2] for w in windows)
+        X_batch = np.empty((self.batchsize,) + windows[0].shape[:2] + (self.cropsize,), dtype=X_specs_pad[0].dtype)
+        targets = []
+
+        def flush(progress):
+            X = torch.from_numpy(X_batch[:len(targets)]).to(self.device)
+            if not self.is_complex:
+                X = torch.abs(X)
+
+            mask = self.model.predict_mask(X)
+            mask = mask.detach().cpu().numpy()
+
+            for (i, patch), patch_mask in zip(targets, mask):
+                masks[i][:, :, patch * roi_size:(patch + 1) * roi_size] = patch_mask
+            progress.update(1)
+            targets.clear()
 
         self.model.eval()
-        with torch.no_grad():
-            mask_list = []
+        with torch.no_grad(), tqdm(total=-(-total // self.batchsize)) as progress:
             # To reduce the overhead, dataloader is not used.
-            for i in tqdm(range(0, patches, self.batchsize)):
-                X_batch = X_dataset[i: i + self.batchsize]
-                X_batch = torch.from_numpy(X_batch).to(self.device)
+            for i, window in enumerate(windows):
+                for patch in range(window.shape[2]):
+                    self.patches += 1
+                    if self._is_silent(window[:, :, patch], roi_size):
+                        # everything is instruments, nothing is vocals
+                        masks[i][:channels // 2, :, patch * roi_size:(patch + 1) * roi_size] = 1
+                        masks[i][channels // 2:, :, patch * roi_size:(patch + 1) * roi_size] = 0
+                        self.skipped_patches += 1
+                        continue
+
+                    X_batch[len(targets)] = window[:, :, patch]
+                    targets.append((i, patch))
+                    if len(targets) == self.batchsize:
+                        flush(progress)
+            if targets:
+                flush(progress)
+
+        return masks
 
-                if not self.is_complex:
-                    X_batch = torch.abs(X_batch)
-
-                mask = self.model.predict_mask(X_batch)
-
-                mask = mask.detach().cpu().numpy()
-                mask = np.concatenate(mask, axis=2)
-                mask_list.append(mask)
-
-            mask = np.concatenate(mask_list, axis=2)
-
-        return mask
+    def _separate(self, X_spec_pad, roi_size):
+        return self._predict([X_spec_pad], roi_size)[0]
 
-    def separate(self, X_spec):
+    def separate(self, X_spec, return_energy=False, stems=STEMS):
+        """
+        Instrument and vocal spectrograms of X_spec, None for the ones not in `stems`. The vocals are computed
+        for the energy either way when `return_energy` is set.
+        """
         n_frame = X_spec.shape[2]
         pad_l, pad_r, roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)
         X_spec_pad = np.pad(X_spec, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
@@ -76,11 +138,56 @@ class Separator(object):
         mask = self._separate(X_spec_pad, roi_size)
         mask = mask[:, :, :n_frame]
 
-        y_spec, v_spec = self._postprocess(X_spec, mask)
+        y_spec, v_spec = self._postprocess(X_spec, mask, stems + (('vocals',) if return_energy else ()))
 
+        if return_energy:
+            return y_spec, v_spec, self.vocal_energy(v_spec)
         return y_spec, v_spec
 
-    def separate_tta(self, X_spec):
+    def separate_batch(self, X_specs, return_energy=False, stems=STEMS):
+        """
+        separate() for several spectrograms at once. The patches of all of them are packed into the same model
+        batches, so short clips don't each run the model on a mostly empty batch.
+        """
+        X_specs_pad = []
+        for X_spec in X_specs:
+            pad_l, pad_r, roi_size = dataset.make_padding(X_spec.shape[2], self.cropsize, self.offset)
+            X_spec_pad = np.pad(X_spec, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
+            X_spec_pad /= np.abs(X_spec).max()
+            X_specs_pad.append(X_spec_pad)
+
+        masks = self._predict(X_specs_pad, roi_size)
+
+        results = []
+        for X_spec, mask in zip(X_specs, masks):
+            y_spec, v_spec = self._postprocess(
+                X_spec, mask[:, :, :X_spec.shape[2]], stems + (('vocals',) if return_energy else ())
+            )
+            results.append((y_spec, v_spec, self.vocal_energy(v_spec)) if return_energy else (y_spec, v_spec))
+        return results
+
+    def separate_stream(self, get_frames, n_frame, peak, block_patches=16, stems=STEMS):
+        """
+        separate() of a spectrogram too long to hold, one block of block_patches patches at a time.
+        `get_frames(start, end)` returns the frames in that range with zeros outside the spectrogram, `peak` is
+        the largest magnitude of the whole spectrogram. Every block is read with the offset frames of context the
+        model sees around it in separate(), so the masks match. Yields (start frame, y_spec, v_spec) per block.
+        """
+        roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)[2]
+        block_size = block_patches * roi_size
+        for start in range(0, n_frame, block_size):
+            end = min(n_frame, start + block_size)
+            patches = -(-(end - start) // roi_size)
+            X_spec = get_frames(start - self.offset, start + patches * roi_size + self.offset)
+            X_spec_pad = X_spec / peak
+
+            mask = self._separate(X_spec_pad, roi_size)
+            mask = mask[:, :, :end - start]
+
+            y_spec, v_spec = self._postprocess(X_spec[:, :, self.offset:self.offset + end - start], mask, stems)
+            yield start, y_spec, v_spec
+
+    def separate_tta(self, X_spec, stems=STEMS):
         n_frame = X_spec.shape[2]
         pad_l, pad_r, roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)
         X_spec_pad = np.pad(X_spec, ((0, 0), (0, 0), (pad_l, pad_r)), mode='constant')
@@ -98,7 +205,7 @@ class Separator(object):
 
         mask = (mask[:, :, :n_frame] + mask_tta[:, :, :n_frame]) * 0.5
 
-        y_spec, v_spec = self._postprocess(X_spec, mask)
+        y_spec, v_spec = self._postprocess(X_spec, mask, stems)
 
         return y_spec, v_spec
 
@@ -121,6 +228,8 @@ def main():
     p.add_argument('--tta', '-t', action='store_true')
     p.add_argument('--output_dir', '-o', type=str, default="")
     p.add_argument('--complex', '-X', action='store_true')
+    p.add_argument('--stft_backend', choices=spec_utils.STFT_BACKENDS, default='librosa')
+    p.add_argument('--silence_threshold', '-S', type=float, default=None, help='skip patches this many dB below the peak, -90 for example')
     args = p.parse_args()
 
     print('loading model...', end=' ')
@@ -147,14 +256,15 @@ def main():
         X = np.asarray([X, X])
 
     print('stft of wave source...', end=' ')
-    X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
+    X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft, args.stft_backend)
     print('done')
 
     sp = Separator(
         model=model,
         device=device,
         batchsize=args.batchsize,
-        cropsize=args.cropsize
+        cropsize=args.cropsize,
+        silence_threshold=args.silence_threshold
     )
 
     if args.tta:
@@ -170,12 +280,12 @@ def main():
     print('done')
 
     print('inverse stft of instruments...', end=' ')
-    wave = spec_utils.spectrogram_to_wave(y_spec, hop_length=args.hop_length)
+    wave = spec_utils.spectrogram_to_wave(y_spec, hop_length=args.hop_length, backend=args.stft_backend)
     print('done')
     sf.write('{}{}_Instruments.wav'.format(output_dir, basename), wave.T, sr)
 
     print('inverse stft of vocals...', end=' ')
-    wave = spec_utils.spectrogram_to_wave(v_spec, hop_length=args.hop_length)
+    wave = spec_utils.spectrogram_to_wave(v_spec, hop_length=args.hop_length, backend=args.stft_backend)
     print('done')
     sf.write('{}{}_Vocals.wav'.format(output_dir, basename), wave.T, sr)
 
@@ -3,6 +3,8 @@ import os
 import librosa
 import numpy as np
 import soundfile as sf
+import soxr
+import torch
 
 
 def crop_center(h1, h2):
@@ -23,7 +25,33 @@ def crop_center(h1, h2):
     return h1
 
 
-def wave_to_spectrogram(wave, hop_length, n_fft):
+STFT_BACKENDS = ('librosa', 'torch')
+
+
+def torch_stft(wave, hop_length, n_fft, center=True):
+    # every channel in one call on torch's intra-op threads, returned as a numpy view of the tensor, not a copy
+    window = torch.hann_window(n_fft, dtype=torch.float64 if wave.dtype == np.float64 else torch.float32)
+    spec = torch.stft(
+        torch.from_numpy(np.ascontiguousarray(wave)), n_fft=n_fft, hop_length=hop_length, window=window,
+        center=center, pad_mode='constant', return_complex=True
+    )
+    return spec.numpy()
+
+
+def torch_istft(spec, hop_length):
+    n_fft = 2 * (spec.shape[-2] - 1)
+    if spec.shape[-1] < 2:
+        # librosa.istft returns no samples for a single frame, torch.istft refuses it
+        return np.zeros(spec.shape[:-2] + (0,), dtype=np.float64 if spec.dtype == np.complex128 else np.float32)
+    window = torch.hann_window(n_fft, dtype=torch.float64 if spec.dtype == np.complex128 else torch.float32)
+    wave = torch.istft(torch.from_numpy(np.ascontiguousarray(spec)), n_fft=n_fft, hop_length=hop_length, window=window)
+    return wave.numpy()
+
+
+def wave_to_spectrogram(wave, hop_length, n_fft, backend='librosa'):
+    if backend == 'torch':
+        return torch_stft(wave[:2], hop_length, n_fft)
+
     spec_left = librosa.stft(wave[0], n_fft=n_fft, hop_length=hop_length)
     spec_right = librosa.stft(wave[1], n_fft=n_fft, hop_length=hop_length)
     spec = np.asarray([spec_left, spec_right])
@@ -119,7 +147,10 @@ def cache_or_load(X_path, y_path, v_path, sr, hop_length, n_fft):
     return X, y, v, X_cache_path, y_cache_path, v_cache_path
 
 
-def spectrogram_to_wave(spec, hop_length=1024):
+def spectrogram_to_wave(spec, hop_length=1024, backend='librosa'):
+    if backend == 'torch':
+        return torch_istft(spec, hop_length)
+
     if spec.ndim == 2:
         wave = librosa.istft(spec, hop_length=hop_length)
     elif spec.ndim == 3:
@@ -130,6 +161,116 @@ def spectrogram_to_wave(spec, hop_length=1024):
     return wave
 
 
+def mono_decimation(sr, target_sr, n_fft, hop_length):
+    # the largest power of two the frames can be shortened by while still holding everything below target_sr / 2
+    factor = 1
+    while sr / (factor * 2) >= target_sr and n_fft % (factor * 2) == 0 and hop_length % (factor * 2) == 0:
+        factor *= 2
+    return factor
+
+
+def mono_spectrogram(spec, factor):
+    """
+    The channels of `spec` averaged, cut to the bins of a transform `factor` times shorter. Its inverse with
+    n_fft // factor and hop_length // factor is the mono wave at sr / factor, band limited to that rate.
+    """
+    bins = (spec.shape[-2] - 1) // factor + 1
+    # irfft scales by 1 / n_fft, the shorter transform needs the bins scaled down to match
+    return spec[:, :bins].mean(axis=0) / factor
+
+
+def spectrogram_to_mono_wave(spec, hop_length, sr, target_sr, backend='librosa'):
+    """
+    Mono wave at target_sr of a stereo spectrogram at sr, for the speech recognizers. Only the bins below the
+    rate of a shortened transform are inverted, once for both channels, which leaves a much smaller resample.
+    """
+    factor = mono_decimation(sr, target_sr, 2 * (spec.shape[1] - 1), hop_length)
+    wave = spectrogram_to_wave(mono_spectrogram(spec, factor), hop_length // factor, backend)
+    return librosa.resample(wave, orig_sr=sr / factor, target_sr=target_sr)
+
+
+def spectrogram_frames(read, n_frame, start, end, hop_length, n_fft, backend='librosa'):
+    """
+    Frames start to end of wave_to_spectrogram() of a wave too long to hold, computed from only the samples they
+    cover. `read(first, last)` returns the (2, last - first) samples of that range with zeros outside the wave,
+    `n_frame` is the number of frames of the whole spectrogram. Frames outside it are zeros.
+    """
+    first, last = max(start, 0), min(end, n_frame)
+    spec = np.zeros((2, n_fft // 2 + 1, end - start), dtype=np.complex64)
+    if first < last:
+        # frame t is centered on sample t * hop_length
+        wave = read(first * hop_length - n_fft // 2, (last - 1) * hop_length + n_fft - n_fft // 2)
+        if backend == 'torch':
+            spec[:, :, first - start:last - start] = torch_stft(wave, hop_length, n_fft, center=False)
+            return spec
+        for channel in range(2):
+            spec[channel, :, first - start:last - start] = librosa.stft(
+                wave[channel], n_fft=n_fft, hop_length=hop_length, center=False
+            )
+    return spec
+
+
+class OverlapAdd(object):
+    """
+    spectrogram_to_wave() of a spectrogram that arrives block by block. Every add() returns the samples no later
+    frame overlaps, so the wave can be written out as it is made and only one frame is ever held back.
+    """
+
+    def __init__(self, n_frame, hop_length, n_fft, channels=2):
+        self.hop_length = hop_length
+        self.n_fft = n_fft
+        self.window = librosa.filters.get_window('hann', n_fft, fftbins=True).astype(np.float32)
+        # the overlapping part of the frames added so far, and the sum of their squared windows
+        self.tail = np.zeros((channels, n_fft - hop_length), dtype=np.float32)
+        self.tail_norm = np.zeros(n_fft - hop_length, dtype=np.float32)
+        # the centered wave starts n_fft // 2 samples into the frames, and is as long as librosa.istft makes it
+        self.position = -(n_fft // 2)
+        self.length = hop_length * (n_frame - 1)
+
+    def _emit(self, wave, norm):
+        nonzero = norm > librosa.util.tiny(norm)
+        wave[:, nonzero] /= norm[nonzero]
+        start, self.position = self.position, self.position + wave.shape[1]
+        return wave[:, max(0, -start):max(0, self.length - start)]
+
+    def add(self, spec):
+        n = spec.shape[2]
+        frames = np.fft.irfft(spec, n=self.n_fft, axis=1).astype(np.float32) * self.window[:, None]
+        wave = np.zeros((spec.shape[0], (n - 1) * self.hop_length + self.n_fft), dtype=np.float32)
+        norm = np.zeros(wave.shape[1], dtype=np.float32)
+        wave[:, :self.tail.shape[1]] = self.tail
+        norm[:self.tail.shape[1]] = self.tail_norm
+        for i in range(n):
+            wave[:, i * self.hop_length:i * self.hop_length + self.n_fft] += frames[:, :, i]
+            norm[i * self.hop_length:i * self.hop_length + self.n_fft] += self.window ** 2
+
+        done = n * self.hop_length
+        self.tail, self.tail_norm = wave[:, done:].copy(), norm[done:].copy()
+        return self._emit(wave[:, :done], norm[:done])
+
+    def finish(self):
+        return self._emit(self.tail, self.tail_norm)
+
+
+class MonoOverlapAdd(object):
+    """
+    spectrogram_to_mono_wave() of a stereo spectrogram that arrives block by block, like OverlapAdd. The
+    resample is streamed as well, so only a few milliseconds of the wave are ever held back.
+    """
+
+    def __init__(self, n_frame, hop_length, n_fft, sr, target_sr):
+        self.factor = mono_decimation(sr, target_sr, n_fft, hop_length)
+        self.overlap_add = OverlapAdd(n_frame, hop_length // self.factor, n_fft // self.factor, channels=1)
+        self.resampler = soxr.ResampleStream(sr / self.factor, target_sr, 1, dtype='float32', quality='HQ')
+
+    def add(self, spec):
+        wave = self.overlap_add.add(mono_spectrogram(spec, self.factor)[None])[0]
+        return self.resampler.resample_chunk(wave)
+
+    def finish(self):
+        return self.resampler.resample_chunk(self.overlap_add.finish()[0], last=True)
+
+
 if __name__ == "__main__":
     import cv2
     import sys